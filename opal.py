@@ -33,6 +33,12 @@ import glob
 import subprocess
 import random
 import threading
+import Queue
+import shutil
+import tempfile
+import itertools
+import collections
+import multiprocessing
 import pandas as pd
 import numpy as np
 from sklearn.metrics import precision_score, recall_score
@@ -44,9 +50,40 @@ sys.path.append(os.path.join(os.path.dirname(script_loc),'util'))
 import ldpc
 import fasta2skm
 import drawfrag
+import checkpoint
+import vwdriver
+import memory
+import fasta_functions
+import predcache
+import readfilter
+import seqstore
+import stages
+import taxonsample
 
 my_env = os.environ.copy()
 
+# Mini-batches of streamed reads that may be waiting for predictions
+STREAM_PENDING = 2
+
+# Seeds of the test fragment draws (frag) and of training (train), for
+# reproducibility
+FRAG_SEED = 42
+TRAIN_SEED = 420
+
+# Arguments that the output of each simulate stage depends on
+FRAG_STAGE_ARGS = ["frag_length", "coverage"]
+TRAIN_STAGE_ARGS = ["frag_length", "coverage", "kmer", "reverse_complement",
+        "hierarchical_weight", "row_weight", "num_hash", "num_batches",
+        "num_passes", "bits", "lambda1", "lambda2", "ensemble", "ldpc_seed",
+        "max_memory", "max_n_fraction", "min_length", "min_complexity",
+        "workers", "total_workers", "first_worker", "holdout_coverage",
+        "patience", "tolerance", "taxon_fragments", "taxon_max_coverage",
+        "taxon_min", "taxon_weight", "cascade_hashes", "design_candidates",
+        "error_rate"]
+PREDICT_STAGE_ARGS = ["kmer", "reverse_complement", "trim_quality",
+        "trim_window", "max_n_fraction", "min_length", "min_complexity",
+        "cascade_threshold"]
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
@@ -74,37 +111,74 @@ def extract_column_two(infile, outfile):
                 else:
                     print('',file=outf)
 
-def vw_class_to_taxid(inputfile, dicofile, outputfile):
-    '''Converts vw IDs in a newline delimited list (inputfile) to
-    outputfile using the mapping specified in dicofile'''
+def read_dico(dicofile):
+    '''Reads the vw ID --> taxid mapping from dicofile'''
     dico = {}
     with open(dicofile, "r") as fin:
         for line in fin:
             txid, vwid = line.strip().split()[:2]
             dico[vwid] = txid
-    predout = open(outputfile, "w")
-    with open(inputfile, "r") as fin:
-        for line_number, line in enumerate(fin):
-            pred_classes_with_prob = line.strip().split()
-            pred_prob_list = []
-
-            if line_number == 0:
-                # Get all TAXIDs in sequence
-                tax_id_list = []
-                for vw_id_prob_pair in pred_classes_with_prob:
-                    vw_id, prob_est = vw_id_prob_pair.split(':')
-                    tx_id = dico[str(int(float(vw_id)))]
-                    tax_id_list.append(tx_id)
-                predout.write("%s\n"%(str('\t'.join(tax_id_list))))
-
+    return dico
+
+def vw_lines_to_taxid(lines, dico, header=True):
+    '''Converts vw --probabilities prediction lines using the vw ID -->
+    taxid mapping dico. Yields a header line with the taxid of each class
+    (unless header is False), followed by one line of tab separated
+    probabilities per prediction.'''
+    for line_number, line in enumerate(lines):
+        pred_classes_with_prob = line.strip().split()
+        pred_prob_list = []
+
+        if line_number == 0 and header:
+            # Get all TAXIDs in sequence
+            tax_id_list = []
             for vw_id_prob_pair in pred_classes_with_prob:
                 vw_id, prob_est = vw_id_prob_pair.split(':')
-                #tx_id = dico[str(int(float(vw_id)))]
-                pred_prob_list.append(prob_est)
+                tx_id = dico[str(int(float(vw_id)))]
+                tax_id_list.append(tx_id)
+            yield "%s\n"%(str('\t'.join(tax_id_list)))
+
+        for vw_id_prob_pair in pred_classes_with_prob:
+            vw_id, prob_est = vw_id_prob_pair.split(':')
+            #tx_id = dico[str(int(float(vw_id)))]
+            pred_prob_list.append(prob_est)
+
+        #predout.write("%s\n"%(dico[str(int(float(line.strip())))]))
+        yield "%s\n"%(str('\t'.join(pred_prob_list)))
 
-            #predout.write("%s\n"%(dico[str(int(float(line.strip())))]))
-            predout.write("%s\n"%(str('\t'.join(pred_prob_list))))
-    predout.close()
+def unclassified_vw_line(dico):
+    '''vw --probabilities style line with probability 0 for every class in
+    dico, standing in for reads that were not classified'''
+    vwids = sorted(dico, key=int)
+    return " ".join("{}:0".format(vwid) for vwid in vwids) + "\n"
+
+def vw_class_to_taxid(inputfile, dicofile, outputfile):
+    '''Converts vw IDs in a newline delimited list (inputfile) to
+    outputfile using the mapping specified in dicofile'''
+    dico = read_dico(dicofile)
+    with open(outputfile, "w") as predout:
+        with open(inputfile, "r") as fin:
+            for out_line in vw_lines_to_taxid(fin, dico):
+                predout.write(out_line)
+
+def average_vw_probabilities(inputfiles, outputfile):
+    '''Averages, line by line, the class probabilities in several vw
+    --probabilities prediction files (e.g. from ensemble members) into
+    outputfile, keeping the same format'''
+    fins = [open(f, "r") for f in inputfiles]
+    with open(outputfile, "w") as fout:
+        for lines in itertools.izip_longest(*fins):
+            if None in lines:
+                raise RuntimeError("Prediction files have different lengths: " + ", ".join(inputfiles))
+            probs = collections.OrderedDict()
+            for line in lines:
+                for vw_id_prob_pair in line.split():
+                    vw_id, prob_est = vw_id_prob_pair.split(':')
+                    probs[vw_id] = probs.get(vw_id, 0.) + float(prob_est)
+            fout.write(" ".join("{}:{:.6g}".format(vw_id, prob / len(lines))
+                for vw_id, prob in probs.items()) + "\n")
+    for fin in fins:
+        fin.close()
 
 def get_fasta_and_taxid(directory):
     '''finds the 'first' fasta file in directory, and returns a tuple with
@@ -118,6 +192,97 @@ def get_fasta_and_taxid(directory):
         raise RuntimeError("Could not find matching taxid: " + taxids)
     return [fasta, taxids]
 
+def get_reference_store(fasta, taxids):
+    '''gets the sequence store made by ./opal.py index for fasta (the
+    matching named .store directory), or None if there is none or it is
+    older than fasta or taxids'''
+    store = os.path.splitext(fasta)[0] + ".store"
+    if seqstore.is_current(store, [fasta, taxids]):
+        return store
+    return None
+
+def reference_args(fasta, taxids):
+    '''drawfrag arguments reading the reference from its sequence store if
+    it has an up to date one, or else from fasta and taxids'''
+    store = get_reference_store(fasta, taxids)
+    if store is not None:
+        return ["--store", store]
+    return ["-i", fasta, "-t", taxids]
+
+# Mate markers of paired-end read file names, as (first mate, second mate)
+MATE_MARKERS = [("_R1", "_R2"), (".R1", ".R2"), ("_1.", "_2.")]
+READ_EXTENSIONS = [".fasta", ".fastq", ".fa", ".fq"]
+
+def get_paired_reads(directory):
+    '''finds the 'first' pair of paired-end read files in directory, named
+    alike but for a mate marker such as _R1/_R2, and returns them as a
+    tuple (first mates, second mates)'''
+    for path in sorted(glob.glob(os.path.join(directory, "*"))):
+        name = os.path.basename(path)
+        if os.path.splitext(name)[1] not in READ_EXTENSIONS:
+            continue
+        for first, second in MATE_MARKERS:
+            i = name.rfind(first)
+            if i < 0:
+                continue
+            mate = os.path.join(directory, name[:i] + second + name[i + len(first):])
+            if os.path.isfile(mate):
+                return (path, mate)
+    raise RuntimeError("Could not find paired-end (R1/R2) read files in: " + directory)
+
+def count_patterns(pattern_file):
+    '''number of LDPC patterns (features per k-mer) in a pattern file'''
+    with open(pattern_file, "r") as f:
+        return int(f.readline().split()[0])
+
+def make_read_filter(args, kmer, num_patterns, reverse, qualities=True):
+    '''Creates a readfilter.ReadFilter from the read filtering arguments, or
+    returns None if no filtering was asked for. Without qualities (e.g. for
+    training fragments), the quality trimming arguments are not used.'''
+    trimming = {}
+    if qualities and args.trim_quality > 0:
+        trimming = {"trim_quality": args.trim_quality,
+                "trim_window": args.trim_window}
+    if (not trimming and args.max_n_fraction >= 1.0 and
+            args.min_length <= 0 and args.min_complexity <= 0):
+        return None
+    return readfilter.ReadFilter(
+            max_n_fraction=args.max_n_fraction,
+            min_length=args.min_length,
+            min_complexity=args.min_complexity,
+            kmer=kmer,
+            num_patterns=num_patterns,
+            reverse=reverse,
+            **trimming)
+
+def holdout_accuracy(prediction_file, taxid_file, dico):
+    '''Compares the most probable class of each vw --probabilities line in
+    prediction_file with the taxid on the same line of taxid_file, using the
+    vw ID --> taxid mapping dico. Returns the fraction correct over all
+    fragments (micro) and averaged over taxids (macro).'''
+    correct = collections.defaultdict(int)
+    total = collections.defaultdict(int)
+    with open(prediction_file, "r") as preds:
+        with open(taxid_file, "r") as taxids:
+            for line, taxid in itertools.izip(preds, taxids):
+                taxid = taxid.strip()
+                pairs = [pair.split(':') for pair in line.split()]
+                vw_id, _ = max(pairs, key=lambda pair: float(pair[1]))
+                total[taxid] += 1
+                if dico[str(int(float(vw_id)))] == taxid:
+                    correct[taxid] += 1
+    if not total:
+        raise RuntimeError("No hold-out predictions in " + prediction_file)
+    micro = sum(correct.values()) * 1.0 / sum(total.values())
+    macro = np.mean([correct[taxid] * 1.0 / total[taxid] for taxid in total])
+    return (micro, macro)
+
+def get_ensemble_members(directory):
+    '''gets the member directories of an ensemble model, in member order, or
+    an empty list if directory holds a single model'''
+    members = glob.glob(os.path.join(directory, "member-*"))
+    return sorted(members, key=lambda d: int(d.rsplit('-', 1)[1]))
+
 def get_final_model(directory):
     '''gets a 'final' model from a directory. Note, will match the first
     file ending in _final.model'''
@@ -157,6 +322,53 @@ def evaluate_predictions(reffile, predfile):
     sys.stdout.flush()
 
 
+def drawfrag_processes_args(processes):
+    '''drawfrag arguments selecting parallel drawing, if processes is set'''
+    if processes:
+        return ["-p", str(processes)]
+    return []
+
+def index(ref_dir, args):
+    '''Converts the fasta file found in ref_dir, with its matching taxid
+    file, into a 2-bit packed sequence store next to it (same basename,
+    ending in .store). frag and train then draw fragments from the store,
+    with the same results, instead of parsing the fasta.
+
+    ref_dir (string):   must be a path to a directory with a single fasta
+                        and taxid file
+    '''
+    fasta, taxids = get_fasta_and_taxid(ref_dir)
+    store_dir = os.path.splitext(fasta)[0] + ".store"
+    starttime = datetime.now()
+    print(
+    '''================================================
+Indexing reference
+{:%Y-%m-%d %H:%M:%S}
+'''.format(starttime) + '''------------------------------------------------
+Fasta input:    {fasta}
+taxids input:   {taxids}
+
+Store output:   {store_dir}'''.format(
+    fasta=fasta, taxids=taxids, store_dir=store_dir)
+    )
+    sys.stdout.flush()
+    store = seqstore.build(fasta, taxids, store_dir)
+    print('''------------------------------------------------
+Records:        {records}
+Bases:          {bases}
+Fasta size:     {fasta_size}
+Packed size:    {packed_size}
+Total wall clock runtime (sec): {runtime}
+================================================'''.format(
+    records=len(store),
+    bases=store.bases,
+    fasta_size=memory.format_memory(os.path.getsize(fasta)),
+    packed_size=memory.format_memory(store.info["packed_bytes"]),
+    runtime=(datetime.now() - starttime).total_seconds()))
+    sys.stdout.flush()
+
+    return 0
+
 def frag(test_dir, frag_dir, args):
     '''Draws fragments from the fasta file found in test_dir. Note that
     there must be a taxid file of the same basename with matching ids for
@@ -170,10 +382,13 @@ def frag(test_dir, frag_dir, args):
         frag_length (int):  length of fragments to be drawn
         coverage (float):   fraction of times each location is to be covered
                             by drawn fragments
+        processes (int):    if set, draw fragments with this many worker
+                            processes (see drawfrag --processes)
     '''
     # Unpack args
     frag_length = args.frag_length
     coverage = args.coverage
+    processes = args.processes
     # Finish unpacking args
 
     fasta, taxids = get_fasta_and_taxid(test_dir)
@@ -203,16 +418,14 @@ taxids output:  {taxid_out}'''.format(
     )
     sys.stdout.flush()
     # set seed (for reproducibility)
-    seed = 42
+    seed = FRAG_SEED
     # draw fragments
-    drawfrag.main([
-        "-i", fasta,
-        "-t", taxids,
+    drawfrag.main(reference_args(fasta, taxids) + [
         "-l", str(frag_length),
         "-c", str(coverage),
         "-o", fasta_out,
         "-g", gi2taxid_out,
-        "-s", str(seed)])
+        "-s", str(seed)] + drawfrag_processes_args(processes))
 
     # extract taxids
     extract_column_two(gi2taxid_out, taxid_out)
@@ -224,6 +437,74 @@ Total wall clock runtime (sec): {}
 
     return 0
 
+def shuffle_seed(batch_seed, member):
+    '''Seed of the order in which the examples of a batch are sent to a
+    model's vw, derived from the batch seed and the model index only.
+    Hosts training one model together rely on it to shard the batch alike
+    (see train_batch).'''
+    return drawfrag.record_seed(batch_seed, member)
+
+def train_batch(task):
+    '''Generates the features of one batch of fragments with one set of LDPC
+    patterns, shuffles them and trains vw on them. Defined at module level
+    so that ensemble members can run in a process pool.
+
+    The task holds one (vw_params, log_file) run per local allreduce worker.
+    Shuffled example e goes to global worker e % total_workers, so the
+    workers on this host (first_worker onwards) each get their own shard.
+    The shards only partition the batch if every host shuffles it the same
+    way, so order_seed must come from shuffle_seed, never from state local
+    to the process or host.
+
+    Returns the reports of the vw drivers and the resident memory of the
+    process while it held the batch.
+    '''
+    (fasta_batch, taxid_batch, dico, kmer, pattern_file, reverse, weights,
+            vw_runs, order_seed, first_worker, total_workers, verbose) = task
+    fasta2skm_namespace = argparse.Namespace(
+            input=fasta_batch,
+            taxid=taxid_batch,
+            kmer=kmer,
+            dico=dico,
+            output=None,
+            pattern=pattern_file,
+            reverse=reverse,
+            weights=weights)
+    if verbose:
+        print("Getting training set ...")
+        sys.stdout.flush()
+    skms = fasta2skm.main_generator(fasta2skm_namespace)
+    training_list = list(skms)
+    peak_rss = memory.current_rss()
+
+    if verbose:
+        print("Shuffling training set ...")
+        sys.stdout.flush()
+    random.Random(order_seed).shuffle(training_list)
+    if verbose:
+        print("Sending data to vowpal_wabbit ...")
+    vws = []
+    try:
+        # Only echo the log of a lone vw; workers' logs interleave badly
+        for vw_params, log_file in vw_runs:
+            vws.append(vwdriver.VWDriver(vw_params, log_file, log_mode='a',
+                echo=verbose and len(vw_runs) == 1, env=my_env))
+        for e, item in enumerate(training_list):
+            worker = e % total_workers - first_worker
+            if 0 <= worker < len(vws):
+                vws[worker].write(item)
+        del training_list
+        # allreduce workers wait for each other, so all of them must have
+        # their input before any of them is waited on
+        for vw in vws:
+            vw.finish()
+        for vw in vws:
+            vw.close()
+    finally:
+        for vw in vws:
+            vw.abort()
+    return ([vw.report() for vw in vws], peak_rss)
+
 def train(ref_dir, model_dir, args):
     '''Draws fragments from the fasta file found in ref_dir. Note that
     there must be a taxid file of the same basename with matching ids for
@@ -245,6 +526,55 @@ def train(ref_dir, model_dir, args):
         num_hash (int):     number of hashing functions
         num_batches (int):  number of times to run vowpal_wabbit
         num_passes (int):   number of passes within vowpal_wabbit
+        ensemble (int):     number of models, each with its own LDPC
+                            patterns, trained concurrently on the same
+                            fragments (saved under model_dir/member-*/)
+        ldpc_seed (int):    seed of the LDPC patterns (member j uses
+                            ldpc_seed + j); random if None
+        design_candidates (int):if > 0, each member's patterns are the best
+                            of this many candidate sets (see ldpc.design)
+        error_rate (float): substitution error rate the candidate pattern
+                            sets are scored at
+        processes (int):    if set, draw fragments with this many worker
+                            processes (see drawfrag --processes)
+        max_n_fraction, min_length, min_complexity:
+                            drop drawn fragments that fail these read
+                            filters (see readfilter.ReadFilter)
+        max_memory (string):if set, a memory budget such as "32G"; the
+                            total coverage (coverage * num_batches) is then
+                            split into as many batches as needed for each
+                            batch to fit, and later batches shrink if the
+                            observed memory use exceeds the estimate
+        resume (bool):      continue from the last complete batch checkpoint
+                            in model_dir instead of starting over
+        workers (int):      number of vw allreduce workers on this host;
+                            each batch is split round-robin between all
+                            workers, which average their weights at the end
+                            of every pass
+        span_server (string):host of the spanning_tree daemon; if None and
+                            there are several workers, one is started here
+        span_port (int):    port of the spanning_tree daemon
+        total_workers (int):workers across all hosts (None: workers)
+        first_worker (int): global index of this host's first worker
+        holdout_coverage (float):if > 0, draw hold-out fragments at this
+                            coverage once, score them against every batch
+                            checkpoint (logged to model_dir/validation.log)
+                            and keep the best scoring model as final
+        patience (int):     stop once hold-out accuracy has not improved by
+                            more than tolerance for this many batches
+        tolerance (float):  smallest accuracy gain counted as improvement
+        taxon_fragments (int):if > 0, draw this many fragments per taxid in
+                            each batch instead of covering every record
+                            coverage times (see util/taxonsample.py)
+        taxon_max_coverage (float):if > 0, draw at most this coverage of a
+                            taxid's records
+        taxon_min (int):    fragments per taxid drawn regardless of the cap
+        taxon_weight (bool):weight each taxid's examples by taxon_fragments
+                            over the fragments it got
+        cascade_hashes (int):if > 0, also train a cheap model on the same
+                            fragments with only the first cascade_hashes
+                            LDPC patterns (of member 0), saved under
+                            model_dir/cascade/ for cascade predict
     '''
     # Unpack args
     frag_length = args.frag_length
@@ -259,6 +589,27 @@ def train(ref_dir, model_dir, args):
     lambda1 = args.lambda1
     lambda2 = args.lambda2
     reverse = args.reverse_complement
+    ensemble = args.ensemble
+    ldpc_seed = args.ldpc_seed
+    design_candidates = args.design_candidates
+    error_rate = args.error_rate
+    processes = args.processes
+    max_memory = args.max_memory
+    resume = args.resume
+    workers = args.workers
+    span_server = args.span_server
+    span_port = args.span_port
+    total_workers = args.total_workers
+    first_worker = args.first_worker
+    holdout_coverage = args.holdout_coverage
+    patience = args.patience
+    tolerance = args.tolerance
+    taxon_fragments = args.taxon_fragments
+    taxon_max_coverage = args.taxon_max_coverage
+    taxon_min = args.taxon_min
+    taxon_weight = args.taxon_weight
+    cascade_hashes = args.cascade_hashes
+    min_length = args.min_length
     # Finish unpacking args
 
     fasta, taxids = get_fasta_and_taxid(ref_dir)
@@ -271,6 +622,24 @@ def train(ref_dir, model_dir, args):
             raise ValueError("Hierarchy middle level [{}] must divide into k-mer length [{}].".format(hierarchical, kmer))
         if hierarchical % row_weight != 0:
             raise ValueError("Row weight[{}] must divide into middle hierarchical structure weight [{}].".format(row_weight, hierarchical))
+    if ensemble < 1:
+        raise ValueError("Ensemble size [{}] must be at least 1.".format(ensemble))
+    if min_length > frag_length:
+        raise ValueError("Minimum read length [{}] must not exceed the fragment length [{}]; every training fragment would be dropped.".format(min_length, frag_length))
+    if total_workers is None:
+        total_workers = workers
+    if workers < 1 or first_worker < 0 or first_worker + workers > total_workers:
+        raise ValueError("Workers {}..{} do not fit into {} total workers.".format(first_worker, first_worker + workers - 1, total_workers))
+    if workers < total_workers and span_server is None:
+        raise ValueError("Training across hosts needs the --span-server they share.")
+    if workers < total_workers and ldpc_seed is None:
+        # Otherwise each host draws its own patterns, and allreduce would
+        # average weights of unrelated features
+        raise ValueError("Training across hosts needs the same --ldpc-seed on every host.")
+    if cascade_hashes > num_hash + 1:
+        raise ValueError("Cascade hashes [{}] must not exceed the number of patterns [{}].".format(cascade_hashes, num_hash + 1))
+    if taxon_fragments > 0 and max_memory:
+        raise ValueError("--max-memory plans batches by coverage; with --taxon-fragments, size batches by lowering it instead.")
 
     print(
     '''================================================
@@ -292,6 +661,8 @@ k-mer length:   {kmer}'''.format(
 num hashes:     {num_hash}
 num batches:    {num_batches}
 num passes:     {num_passes}
+ensemble size:  {ensemble}
+vw workers:     {workers} of {total_workers}
 ------------------------------------------------
 Fasta input:    {fasta}
 taxids input:   {taxids}
@@ -300,6 +671,9 @@ taxids input:   {taxids}
     num_hash=num_hash,
     num_batches=num_batches,
     num_passes=num_passes,
+    ensemble=ensemble,
+    workers=workers,
+    total_workers=total_workers,
     fasta=fasta,
     taxids=taxids)
     )
@@ -314,92 +688,382 @@ taxids input:   {taxids}
     dico = os.path.join(model_dir, "vw-dico.txt")
 
     # define model prefix
-    model_prefix = os.path.join(model_dir, "vw-model")
+    # A single model lives directly in model_dir. An ensemble keeps each
+    # member's patterns and vw model in model_dir/member-<j>/, and all
+    # members share the dictionary and the fragment draws.
+    if ensemble > 1:
+        member_dirs = [os.path.join(model_dir, "member-{}".format(j)) for j in range(ensemble)]
+    else:
+        member_dirs = [model_dir]
+    # The cheap cascade model, if any, is trained as one more model after
+    # the members, on a subset of member 0's patterns
+    cascade_dir = os.path.join(model_dir, "cascade")
+    model_dirs = member_dirs + ([cascade_dir] if cascade_hashes > 0 else [])
+    member_prefixes = [os.path.join(d, "vw-model") for d in model_dirs]
+    pattern_files = [os.path.join(d, "patterns.txt") for d in model_dirs]
+    num_models = len(model_dirs)
+    checkpoint_dir = os.path.join(model_dir, "checkpoints")
+    best_models = checkpoint.best_paths(checkpoint_dir, num_models)
+    holdout_prefix = os.path.join(model_dir, "holdout")
+    validation_log = os.path.join(model_dir, "validation.log")
+
+    # Parameters that a checkpoint is only valid for
+    checkpoint_params = {
+        "frag_length": frag_length,
+        "coverage": coverage,
+        "kmer": kmer,
+        "row_weight": row_weight,
+        "hierarchical": hierarchical,
+        "num_hash": num_hash,
+        "num_passes": num_passes,
+        "bits": bits,
+        "lambda1": lambda1,
+        "lambda2": lambda2,
+        "reverse": reverse,
+        "ensemble": ensemble,
+        "cascade_hashes": cascade_hashes,
+        "ldpc_seed": ldpc_seed,
+        "design_candidates": design_candidates,
+        "error_rate": error_rate if design_candidates > 0 else None,
+        "parallel_draws": bool(processes),
+        "total_workers": total_workers,
+        "holdout_coverage": holdout_coverage,
+        "taxon_sampling": [taxon_fragments, taxon_max_coverage, taxon_min,
+            taxon_weight],
+        "read_filter": [args.max_n_fraction, args.min_length, args.min_complexity]}
+
+    state = None
+    if resume:
+        state = checkpoint.load(checkpoint_dir)
+        if state is None:
+            print("No checkpoint found in {}; starting from scratch".format(checkpoint_dir))
+        elif state["params"] != checkpoint_params:
+            raise ValueError("Checkpoint in {} was made with different parameters: {}".format(checkpoint_dir, state["params"]))
+    if state is None:
+        checkpoint.clear(checkpoint_dir)
+        safe_makedirs(checkpoint_dir)
+        # Remove the members of an earlier, larger ensemble, which predict
+        # would otherwise average in
+        for member_dir in get_ensemble_members(model_dir):
+            if member_dir not in member_dirs:
+                shutil.rmtree(member_dir)
+        # Likewise an earlier cascade model, which was trained against an
+        # earlier dictionary
+        if cascade_hashes == 0 and os.path.isdir(cascade_dir):
+            shutil.rmtree(cascade_dir)
+        # Register every label up front, so the dictionary exists even if a
+        # batch ends up without fragments (e.g. all dropped by read filters)
+        with open(taxids, 'r') as taxid_file:
+            fasta2skm.update_dictionary(taxid_file, dico)
+        # generate LDPC spaced pattern
+        for j, (member_dir, pattern_file) in enumerate(zip(member_dirs, pattern_files)):
+            safe_makedirs(member_dir)
+            member_seed = None if ldpc_seed is None else ldpc_seed + j
+            if design_candidates > 0:
+                scores = ldpc.design_write(k=kmer, t=row_weight, _m=num_hash,
+                        d=pattern_file, candidates=design_candidates,
+                        error_rate=error_rate, seed=member_seed,
+                        hierarchical=hierarchical, processes=processes)
+                sensitivities = [s for _, s, _ in scores]
+                print("Patterns {}: best of {} candidates, sensitivity {:.4f} (candidates {:.4f}-{:.4f}), overlap {:.4f}".format(
+                    pattern_file, len(scores), scores[0][1],
+                    min(sensitivities), max(sensitivities), scores[0][2]))
+            elif hierarchical > 0:
+                ldpc.hierarchical_ldpc_write(k=kmer, t1=hierarchical,
+                        t2=row_weight, _m=num_hash, d=pattern_file,
+                        seed=member_seed)
+            else:
+                ldpc.ldpc_write(k=kmer, t=row_weight, _m=num_hash,
+                        d=pattern_file, seed=member_seed)
+        if cascade_hashes > 0:
+            safe_makedirs(cascade_dir)
+            ldpc.write_patterns(np.load(ldpc.binary_pattern_file(
+                pattern_files[0]))[:cascade_hashes], pattern_files[-1])
+        if holdout_coverage > 0:
+            with open(validation_log, 'w') as f:
+                f.write("batch\tcoverage\tmicro\tmacro\n")
+        start_batch = 0
+        prev_models = None
+    else:
+        # Undo any dictionary update made by an interrupted batch
+        checkpoint.atomic_copy(state["dico"], dico)
+        random.setstate(state["rng_state"])
+        start_batch = state["batch"] + 1
+        prev_models = state["models"]
+        print("Resuming from checkpoint of batch {}".format(state["batch"]))
+    sys.stdout.flush()
 
-    # generate LDPC spaced pattern
-    pattern_file = os.path.join(model_dir, "patterns.txt")
-    ldpc.ldpc_write(k=kmer, t=row_weight, _m=num_hash, d=pattern_file)
+    # Training fragments have no qualities, but can still be filtered on
+    # N content and complexity
+    read_filter = make_read_filter(args, kmer,
+            (num_hash + 1) * ensemble + cascade_hashes, reverse,
+            qualities=False)
+
+    # The hold-out fragments are drawn once, with their own seed, and kept
+    # for resumed runs
+    seed = TRAIN_SEED
+    validation = []
+    best_batch = None
+    stopped = False
+    if holdout_coverage > 0:
+        holdout_fasta = holdout_prefix + ".fasta"
+        holdout_taxid = holdout_prefix + ".taxid"
+        if state is None or not os.path.isfile(holdout_taxid):
+            print("Drawing hold-out fragments (coverage {:.4g})".format(holdout_coverage))
+            drawfrag.main(reference_args(fasta, taxids) + [
+                "-l", str(frag_length),
+                "-c", str(holdout_coverage),
+                "-o", holdout_fasta,
+                "-g", holdout_prefix + ".gi2taxid",
+                "-s", str(seed - 1)] + drawfrag_processes_args(processes))
+            extract_column_two(holdout_prefix + ".gi2taxid", holdout_taxid)
+            if read_filter is not None:
+                readfilter.filter_batch(holdout_fasta,
+                        [holdout_taxid, holdout_prefix + ".gi2taxid"],
+                        read_filter)
+            os.remove(holdout_prefix + ".gi2taxid")
+        if state is not None:
+            validation = state.get("validation", [])
+            best_batch = state.get("best_batch")
+        if best_batch is not None and state["batch"] - best_batch >= patience:
+            stopped = True
+            print("Hold-out accuracy already stopped improving at batch {}".format(best_batch))
+
+    # Taxon-balanced sampling replaces the per-record coverage with the
+    # fragment counts planned here, drawn again in every batch
+    counts_file = None
+    weights = None
+    if taxon_fragments > 0:
+        store = get_reference_store(fasta, taxids)
+        if store is not None:
+            lengths = seqstore.open_store(store).records[:, 1]
+            labels = seqstore.open_store(store).taxids
+        else:
+            lengths, labels = taxonsample.record_lengths(fasta, taxids)
+        counts, taxon_counts = taxonsample.fragment_counts(lengths, labels,
+                frag_length, taxon_fragments, taxon_max_coverage, taxon_min)
+        counts_file = os.path.join(model_dir, "taxon-fragments.txt")
+        taxonsample.write_counts(counts, counts_file)
+        if taxon_weight:
+            weights = taxonsample.taxon_weights(taxon_counts, taxon_fragments)
+        table = taxonsample.report(taxon_counts, weights)
+        with open(os.path.join(model_dir, "taxon-counts.tsv"), 'w') as f:
+            f.write(table + "\n")
+        print('''Taxon-balanced sampling: {fragments} fragments per batch over {taxa} taxids
+(coverage {coverage} of every record would draw {coverage_fragments:.0f})
+{table}'''.format(
+            fragments=sum(taxon_counts.values()),
+            taxa=len(taxon_counts),
+            coverage=coverage,
+            coverage_fragments=coverage * sum(lengths) / frag_length,
+            table=table))
+        sys.stdout.flush()
 
-    seed = 420
-    final_model_file = model_prefix + "_final.model"
-    # Initialize Vowpal_Wabbit model
+    # Plan the per-batch coverage. Without a memory budget, this is simply
+    # num_batches batches at the given coverage.
+    total_coverage = coverage * num_batches
+    batch_coverage = coverage
+    covered = 0.
+    if max_memory:
+        budget = memory.parse_memory(max_memory)
+        store = get_reference_store(fasta, taxids)
+        if store is not None:
+            ref_length = seqstore.open_store(store).bases
+        else:
+            ref_length = memory.reference_length(fasta)
+        bytes_per_coverage = memory.coverage_bytes(ref_length, frag_length,
+                kmer, num_hash, row_weight, reverse, num_models)
+        baseline_rss = memory.current_rss()
+        batch_coverage = memory.plan_coverage(coverage, bytes_per_coverage,
+                budget - baseline_rss)
+        print('''memory budget:  {budget} ({available} available)
+reference length: {ref_length}
+estimated memory per unit of coverage: {per_coverage}'''.format(
+            budget=memory.format_memory(budget),
+            available=memory.format_memory(budget - baseline_rss),
+            ref_length=ref_length,
+            per_coverage=memory.format_memory(bytes_per_coverage)))
+    if state is not None:
+        covered = state["coverage_done"]
+        batch_coverage = state["batch_coverage"]
+    print("Planned batches: {} at coverage {:.4g} per batch (total coverage {:.4g})".format(
+        start_batch + memory.plan_batches(total_coverage - covered, batch_coverage),
+        batch_coverage, total_coverage))
+    sys.stdout.flush()
+
+    # Each batch runs its own vw per member (or its own allreduce workers),
+    # which continues from the previous batch's --save_resume model and
+    # writes a checkpoint
     vw_params_base = ["vw",
         "--random_seed", str(seed),
-        "-f", final_model_file,
         "--save_resume",
         "--oaa", str(num_labels),
         "--bit_precision", str(bits),
         "--l1", str(lambda1),
         "--l2", str(lambda2)]
-    vw_params_passes = [
-        "--cache_file", model_prefix + ".cache",
-        "--passes", str(num_passes)]
-    vw_params = vw_params_base
-    if num_passes > 1:
-        vw_params = vw_params + vw_params_passes
-
-    vwps_training_log = model_prefix + "_vwps.log"
-    vwps_log_fh_write = open(vwps_training_log, 'w')
-    vwps_log_fh_tail = open(vwps_training_log, 'r')
-    vwps = subprocess.Popen(vw_params, env=my_env,
-            stdin=subprocess.PIPE, stdout=vwps_log_fh_write,
-            stderr=vwps_log_fh_write)
-    for i in range(num_batches):
-        seed = seed + 1
-        batch_prefix = os.path.join(model_dir, "train.batch-{}".format(i))
-        fasta_batch = batch_prefix + ".fasta"
-        gi2taxid_batch = batch_prefix + ".gi2taxid"
-        taxid_batch = batch_prefix + ".taxid"
-
-        # draw fragments
-        print("Drawing fragments for batch {}".format(i))
-        drawfrag.main([
-            "-i", fasta,
-            "-t", taxids,
-            "-l", str(frag_length),
-            "-c", str(coverage),
-            "-o", fasta_batch,
-            "-g", gi2taxid_batch,
-            "-s", str(seed)])
-        # extract taxids
-        extract_column_two(gi2taxid_batch, taxid_batch)
-
-        fasta2skm_namespace = argparse.Namespace(
-                input=fasta_batch,
-                taxid=taxid_batch,
-                kmer=kmer,
-                dico=dico,
-                output=None,
-                pattern=pattern_file,
-                reverse=reverse)
-        print("Getting training set ...")
-        sys.stdout.flush()
-        skms = fasta2skm.main_generator(fasta2skm_namespace)
-        training_list = [line.rstrip('\n') for line in skms]
-
-        print("Shuffling training set ...")
-        sys.stdout.flush()
-        random.shuffle(training_list)
-        print("Sending data to vowpal_wabbit ...")
-        batch_i = 0
-        for item in training_list:
-            vwps.stdin.write("{}\n".format(item))
-            batch_i = batch_i + 1
-            if batch_i % 100000 == 0:
-                latest_data = vwps_log_fh_tail.read()
-                if latest_data:
-                    print(latest_data, end="")
-        latest_data =vwps_log_fh_tail.read()
-        if latest_data:
-            print(latest_data, end="")
-        os.remove(fasta_batch)
-        os.remove(taxid_batch)
-        os.remove(gi2taxid_batch)
-    vwps_log_fh_tail.close()
-    vwps_log_fh_write.close()
-    vwps.stdin.close()
-    #print("vowpal_wabbit running with to-be-saved model: {}".format(final_model_file))
-    vwps.wait()
+    # vw runs of each member, as (file prefix, global worker index)
+    worker_runs = []
+    for member_prefix in member_prefixes:
+        if total_workers > 1:
+            runs = [("{}.worker-{}".format(member_prefix, g), g)
+                    for g in range(first_worker, first_worker + workers)]
+        else:
+            runs = [(member_prefix, 0)]
+        worker_runs.append(runs)
+        if state is None:
+            for worker_prefix, _ in runs:
+                open(worker_prefix + "_vwps.log", 'w').close()
+
+    # The spanning tree connects the allreduce workers of each vw run
+    spanning_tree = None
+    if total_workers > 1 and span_server is None:
+        spanning_tree = vwdriver.SpanningTree(span_port,
+                os.path.join(model_dir, "spanning_tree.log"), env=my_env)
+        span_server = "localhost"
+
+    # One process pool runs the ensemble members' (and cascade model's) vw
+    # learners concurrently
+    pool = multiprocessing.Pool(num_models) if num_models > 1 else None
+    try:
+        i = start_batch
+        while total_coverage - covered > 1e-9 and not stopped:
+            this_coverage = min(batch_coverage, total_coverage - covered)
+            batch_seed = seed + 1 + i
+            batch_prefix = os.path.join(model_dir, "train.batch-{}".format(i))
+            fasta_batch = batch_prefix + ".fasta"
+            gi2taxid_batch = batch_prefix + ".gi2taxid"
+            taxid_batch = batch_prefix + ".taxid"
+
+            # draw fragments
+            print("Drawing fragments for batch {} (coverage {:.4g})".format(i, this_coverage))
+            drawfrag.main(reference_args(fasta, taxids) + [
+                "-l", str(frag_length),
+                "-c", str(this_coverage),
+                "-o", fasta_batch,
+                "-g", gi2taxid_batch,
+                "-s", str(batch_seed)] + drawfrag_processes_args(processes) +
+                (["-n", counts_file] if counts_file else []))
+            # extract taxids
+            extract_column_two(gi2taxid_batch, taxid_batch)
+            if read_filter is not None:
+                readfilter.filter_batch(fasta_batch,
+                        [taxid_batch, gi2taxid_batch], read_filter)
+                print(read_filter.report())
+            with open(taxid_batch, 'r') as taxid_file:
+                if not any(True for _ in taxid_file):
+                    raise RuntimeError("Batch {} has no training fragments left; check the read filters and fragment length".format(i))
+            # update the shared dictionary once, before members read it
+            with open(taxid_batch, 'r') as taxid_file:
+                fasta2skm.update_dictionary(taxid_file, dico)
+
+            tasks = []
+            model_batches = []
+            for j, member_prefix in enumerate(member_prefixes):
+                model_batch = "{}.batch-{}.model".format(member_prefix, i)
+                vw_runs = []
+                for w, (worker_prefix, g) in enumerate(worker_runs[j]):
+                    vw_params = list(vw_params_base)
+                    if num_passes > 1:
+                        vw_params += ["-k",
+                            "--cache_file", worker_prefix + ".cache",
+                            "--passes", str(num_passes)]
+                    if total_workers > 1:
+                        vw_params += [
+                            "--span_server", span_server,
+                            "--span_server_port", str(span_port),
+                            "--unique_id", str(batch_seed * num_models + j),
+                            "--total", str(total_workers),
+                            "--node", str(g)]
+                    # Workers end each batch with the same weights, so the
+                    # first one on this host writes the model
+                    if w == 0:
+                        vw_params += ["-f", model_batch]
+                    if prev_models:
+                        vw_params += ["-i", prev_models[j]]
+                    vw_runs.append((vw_params, worker_prefix + "_vwps.log"))
+                tasks.append((fasta_batch, taxid_batch, dico, kmer,
+                    pattern_files[j], reverse, weights, vw_runs,
+                    # The same on every host, which the sharding relies on
+                    shuffle_seed(batch_seed, j), first_worker, total_workers,
+                    pool is None))
+                model_batches.append(model_batch)
+            if pool is None:
+                results = [train_batch(tasks[0])]
+            else:
+                print("Training {} models ...".format(num_models))
+                sys.stdout.flush()
+                results = pool.map(train_batch, tasks)
+            for reports, _ in results:
+                for report in reports:
+                    print(report)
+            os.remove(fasta_batch)
+            os.remove(taxid_batch)
+            os.remove(gi2taxid_batch)
+            covered = covered + this_coverage
+            if max_memory:
+                # Shrink later batches if the batch went over the memory
+                # the plan allowed for
+                used = sum(peak_rss - baseline_rss for _, peak_rss in results)
+                print("Batch memory: {} (estimated {})".format(
+                    memory.format_memory(used),
+                    memory.format_memory(bytes_per_coverage * this_coverage)))
+                if used > memory.SAFETY * (budget - baseline_rss):
+                    bytes_per_coverage = max(bytes_per_coverage, used / this_coverage)
+                    new_coverage = min(batch_coverage, memory.plan_coverage(
+                            coverage, bytes_per_coverage, budget - baseline_rss))
+                    if new_coverage < batch_coverage:
+                        batch_coverage = new_coverage
+                        print("Shrinking later batches to coverage {:.4g} ({} more batches)".format(
+                            batch_coverage,
+                            memory.plan_batches(total_coverage - covered, batch_coverage)))
+            extra = {}
+            if holdout_coverage > 0:
+                # Score the hold-out fragments against the batch model
+                print("Scoring hold-out fragments ...")
+                sys.stdout.flush()
+                prediction_file = score_fasta(holdout_fasta,
+                        model_batches[:ensemble], pattern_files[:ensemble],
+                        holdout_prefix, kmer, reverse)
+                micro, macro = holdout_accuracy(prediction_file,
+                        holdout_taxid, read_dico(dico))
+                with open(validation_log, 'a') as f:
+                    f.write("{}\t{:.6g}\t{:.4f}\t{:.4f}\n".format(i, covered, micro, macro))
+                print("Hold-out accuracy: micro = {:.4f}, macro = {:.4f}".format(micro, macro))
+                best_micro = None
+                for entry in validation:
+                    if entry["batch"] == best_batch:
+                        best_micro = entry["micro"]
+                validation.append({"batch": i, "coverage": covered,
+                    "micro": micro, "macro": macro})
+                if best_micro is None or micro > best_micro + tolerance:
+                    best_batch = i
+                    for model_batch, best_model in zip(model_batches, best_models):
+                        checkpoint.atomic_copy(model_batch, best_model)
+                elif i - best_batch >= patience:
+                    stopped = True
+                    print("Stopping early: hold-out accuracy has not improved by more than {} in {} batches".format(tolerance, patience))
+                extra = {"validation": validation, "best_batch": best_batch}
+            state = checkpoint.save(checkpoint_dir, i, batch_seed, model_batches,
+                    dico, random.getstate(), checkpoint_params,
+                    coverage_done=covered, batch_coverage=batch_coverage,
+                    **extra)
+            prev_models = state["models"]
+            print("Checkpoint saved for batch {}".format(i))
+            sys.stdout.flush()
+            i = i + 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if spanning_tree is not None:
+            spanning_tree.stop()
+    if prev_models is None:
+        raise RuntimeError("No batches were trained; check --num-batches")
+    if best_batch is not None:
+        print("Keeping the model of batch {} (best hold-out accuracy)".format(best_batch))
+        prev_models = best_models
+    for prev_model, member_prefix in zip(prev_models, member_prefixes):
+        checkpoint.atomic_copy(prev_model, member_prefix + "_final.model")
     print('''------------------------------------------------
 Total wall clock runtime (sec): {}
 ================================================'''.format(
@@ -408,6 +1072,123 @@ Total wall clock runtime (sec): {}
     return 0
 
 
+def score_fasta(fasta, models, pattern_files, prefix, kmer, reverse,
+        mates=None):
+    '''Scores the reads in fasta with vw models (one per ensemble member,
+    each with its own pattern file). The vw --probabilities predictions are
+    written to prefix + ".preds.vw", which is returned; for an ensemble, the
+    members' probabilities are averaged into it. If mates is given, it holds
+    the second mates of paired-end reads, and each pair is scored as one
+    example.'''
+    prediction_file = prefix + ".preds.vw"
+    if len(models) == 1:
+        member_prefixes = [prefix]
+    else:
+        member_prefixes = ["{}.member-{}".format(prefix, j) for j in range(len(models))]
+    fasta2skm_namespace = argparse.Namespace(
+            input=fasta,
+            taxid=None,
+            kmer=kmer,
+            dico=None,
+            output=None,
+            pattern=None,
+            reverse=reverse,
+            mates=mates)
+    vws = []
+    try:
+        for member_model, member_prefix in zip(models, member_prefixes):
+            vw_param_list = ["vw", "-t",
+                "-i", member_model,
+                "--probabilities",
+                "-p", member_prefix + ".preds.vw"]
+            vwps_training_log = member_prefix + "_vwps.log"
+            vws.append(vwdriver.VWDriver(vw_param_list, vwps_training_log,
+                echo=len(models) == 1, env=my_env))
+        # One pass over the reads computes the features of every pattern set
+        skms = fasta2skm.ensemble_generator(fasta2skm_namespace, pattern_files)
+        for items in skms:
+            for vw, item in zip(vws, items):
+                vw.write(item)
+        for vw in vws:
+            vw.close()
+            print(vw.report())
+    finally:
+        for vw in vws:
+            vw.abort()
+    if len(models) > 1:
+        average_vw_probabilities(
+            [member_prefix + ".preds.vw" for member_prefix in member_prefixes],
+            prediction_file)
+    return prediction_file
+
+def cascade_score_fasta(fasta, models, pattern_files, cascade, prefix, kmer,
+        reverse, mates=None):
+    '''Like score_fasta, but scores every read with the cheap cascade model
+    first, given as a (model, pattern_file, threshold) tuple, and only
+    re-featurizes and scores the reads whose most probable class has a
+    probability below threshold with the full models. Prints the fraction of
+    reads escalated and the throughput of each stage.'''
+    cascade_model, cascade_patterns, threshold = cascade
+    prediction_file = prefix + ".preds.vw"
+    t0 = datetime.now()
+    cheap_preds = score_fasta(fasta, [cascade_model], [cascade_patterns],
+            prefix + ".cascade", kmer, reverse, mates)
+    t1 = datetime.now()
+
+    # Collect the reads the cheap model is not confident about
+    escalated_fasta = prefix + ".escalated.fasta"
+    escalated_mates = prefix + ".escalated.mates.fasta" if mates else None
+    escalate = []
+    with open(cheap_preds, "r") as pin, open(fasta, "r") as fin:
+        records = fasta_functions.fastx_reader(fin)
+        with open(escalated_fasta, "w") as fout:
+            for line, (name, seq, _) in itertools.izip(pin, records):
+                confidence = max(float(pair.split(':')[1]) for pair in line.split())
+                escalate.append(confidence < threshold)
+                if escalate[-1]:
+                    fout.write(">{}\n{}\n".format(name, seq))
+    if mates:
+        with open(mates, "r") as min_, open(escalated_mates, "w") as mout:
+            for flag, (name, seq, _) in itertools.izip(escalate, fasta_functions.fastx_reader(min_)):
+                if flag:
+                    mout.write(">{}\n{}\n".format(name, seq))
+    num_escalated = sum(escalate)
+    t2 = datetime.now()
+    if num_escalated > 0:
+        full_preds = score_fasta(escalated_fasta, models, pattern_files,
+                prefix + ".escalated", kmer, reverse, escalated_mates)
+    t3 = datetime.now()
+
+    # Merge, in read order
+    with open(cheap_preds, "r") as pin, open(prediction_file, "w") as pout:
+        full_in = open(full_preds, "r") if num_escalated > 0 else None
+        for flag, line in itertools.izip(escalate, pin):
+            pout.write(full_in.readline() if flag else line)
+        if full_in is not None:
+            full_in.close()
+    os.remove(escalated_fasta)
+    if mates:
+        os.remove(escalated_mates)
+
+    def rate(reads, start, end):
+        seconds = (end - start).total_seconds()
+        return reads / seconds if seconds > 0 else float('inf')
+    reads = len(escalate)
+    print('''Cascade threshold:  {threshold}
+Reads escalated:    {escalated} of {reads} ({fraction:.2%})
+Cheap model:        {cheap_rate:.1f} reads/s
+Full model:         {full_rate:.1f} escalated reads/s
+Overall:            {rate:.1f} reads/s'''.format(
+        threshold=threshold,
+        escalated=num_escalated,
+        reads=reads,
+        fraction=num_escalated * 1.0 / max(reads, 1),
+        cheap_rate=rate(reads, t0, t1),
+        full_rate=rate(num_escalated, t2, t3),
+        rate=rate(reads, t0, t3)))
+    sys.stdout.flush()
+    return prediction_file
+
 def predict(model_dir, test_dir, predict_dir, args):
     '''Draws fragments from the fasta file found in data_dir. Note that
     there must be a taxid file of the same basename with matching ids for
@@ -420,6 +1201,28 @@ def predict(model_dir, test_dir, predict_dir, args):
 
     Unpacking args:
         kmer (int):         size of k-mers used
+        dedup (bool):       featurize and score each distinct read sequence
+                            only once, expanding the predictions back to
+                            every read
+        cache_size (int):   if > 0, also keep an LRU cache of this many
+                            read sequence --> prediction entries in
+                            model_dir, reused across runs with the same
+                            model (implies dedup)
+        trim_quality, trim_window, max_n_fraction, min_length,
+        min_complexity:     quality trimming and read filters applied
+                            before featurization (see readfilter.ReadFilter);
+                            dropped reads are reported as unclassified, with
+                            probability 0 for every class
+        paired (bool):      test_dir holds paired-end R1/R2 read files (see
+                            get_paired_reads); the features of both mates
+                            form one example, with one prediction per pair.
+                            A pair is dropped by the read filters only if
+                            both mates fail them.
+        cascade_threshold (float):if > 0, score reads with the cheap model
+                            in model_dir/cascade/ first (see train
+                            --cascade-hashes), and with the full model only
+                            when the cheap model's top class probability is
+                            below this
 
     Returns a tuple with (reffile, predicted_labels_file) for easy input
     into evaluate_predictions.
@@ -427,17 +1230,40 @@ def predict(model_dir, test_dir, predict_dir, args):
     # Unpack args
     kmer = args.kmer
     reverse = args.reverse_complement
+    dedup = args.dedup
+    cache_size = args.cache_size
+    paired = getattr(args, "paired", False) # not an option of simulate
+    cascade_threshold = args.cascade_threshold
     # Finish unpacking args
 
     # Don't need to get taxids until eval
     #fasta, taxids = get_fasta_and_taxid(test_dir)
-    try:
-        fasta = glob.glob(test_dir + "/*.fasta")[0]
-    except:
-        raise RuntimeError("No fasta file found in: " + test_dir)
-    model = get_final_model(model_dir)
+    mates = None
+    if paired:
+        fasta, mates = get_paired_reads(test_dir)
+    else:
+        try:
+            fasta = glob.glob(test_dir + "/*.fasta")[0]
+        except:
+            raise RuntimeError("No fasta file found in: " + test_dir)
+    # An ensemble model has one model and pattern file per member, and the
+    # members' probabilities are averaged
+    member_dirs = get_ensemble_members(model_dir) or [model_dir]
+    models = [get_final_model(d) for d in member_dirs]
+    pattern_files = [os.path.join(d, "patterns.txt") for d in member_dirs]
+    model = ", ".join(models)
+    pattern_file = ", ".join(pattern_files)
     dico = os.path.join(model_dir, "vw-dico.txt")
-    pattern_file = os.path.join(model_dir, "patterns.txt")
+    cascade = None
+    cascade_files = []
+    if cascade_threshold > 0:
+        cascade_dir = os.path.join(model_dir, "cascade")
+        if not os.path.isdir(cascade_dir):
+            raise RuntimeError("No cascade model in {}; train with --cascade-hashes".format(model_dir))
+        cascade_files = [get_final_model(cascade_dir),
+                os.path.join(cascade_dir, "patterns.txt")]
+        cascade = tuple(cascade_files) + (cascade_threshold,)
+        model = model + " (cascade: {})".format(cascade_files[0])
     starttime = datetime.now()
     print(
     '''================================================
@@ -459,46 +1285,119 @@ reverse-complements: {reverse}
     pattern_file=pattern_file,
     reverse=reverse)
     )
+    if paired:
+        print("Mates input:    {}".format(mates))
     sys.stdout.flush()
     safe_makedirs(predict_dir)
     prefix = os.path.join(predict_dir, "test.fragments-db")
     prediction_file = prefix + ".preds.vw"
 
-    # get vw predictions
-    vw_param_list = ["vw", "-t",
-        "-i", model,
-        "--probabilities",
-        "-p", prefix + ".preds.vw"]
-    vwps_training_log = prefix + "_vwps.log"
-    vwps_log_fh_write = open(vwps_training_log, 'w')
-    vwps_log_fh_tail = open(vwps_training_log, 'r')
-    vwps = subprocess.Popen(vw_param_list, env=my_env,
-            stdin=subprocess.PIPE, stdout=vwps_log_fh_write,
-            stderr=vwps_log_fh_write)
-    fasta2skm_namespace = argparse.Namespace(
-            input=fasta,
-            taxid=None,
-            kmer=kmer,
-            dico=None,
-            output=None,
-            pattern=pattern_file,
-            reverse=reverse)
-    skms = fasta2skm.main_generator(fasta2skm_namespace)
-    batch_i = 0
-    for item in skms:
-        vwps.stdin.write("{}".format(item))
-        batch_i = batch_i + 1
-        if batch_i % 100000 == 0:
-            latest_data = vwps_log_fh_tail.read()
-            if latest_data:
-                print(latest_data, end="")
-    latest_data =vwps_log_fh_tail.read()
-    if latest_data:
-        print(latest_data, end="")
-    vwps_log_fh_tail.close()
-    vwps_log_fh_write.close()
-    vwps.stdin.close()
-    vwps.wait()
+    def score(score_fasta_input, score_prefix, score_mates):
+        if cascade is None:
+            return score_fasta(score_fasta_input, models, pattern_files,
+                    score_prefix, kmer, reverse, score_mates)
+        return cascade_score_fasta(score_fasta_input, models, pattern_files,
+                cascade, score_prefix, kmer, reverse, score_mates)
+
+    # Trim and filter reads before featurization
+    read_filter = make_read_filter(args, kmer,
+            sum(count_patterns(p) for p in pattern_files), reverse)
+    keep = None
+    if read_filter is not None:
+        filtered_fasta = prefix + ".filtered.fasta"
+        if paired:
+            filtered_mates = prefix + ".filtered.mates.fasta"
+            keep = readfilter.filter_pairs(fasta, mates, filtered_fasta,
+                    filtered_mates, read_filter)
+            mates = filtered_mates
+        else:
+            keep = readfilter.filter_fastx(fasta, filtered_fasta, read_filter)
+        print(read_filter.report())
+        sys.stdout.flush()
+        fasta = filtered_fasta
+    elif paired and not (dedup or cache_size > 0):
+        # Check that the mates pair up before any vw starts; the filter and
+        # dedup passes check them as they read the pairs
+        with open(fasta, "r") as fin:
+            with open(mates, "r") as mate_in:
+                for _ in fasta_functions.paired_reader(fin, mate_in):
+                    pass
+
+    if dedup or cache_size > 0:
+        # Only distinct reads that are not in the cache get scored
+        unique_fasta = prefix + ".unique.fasta"
+        unique_mates = None
+        with open(fasta, "r") as fin:
+            if paired:
+                unique_mates = prefix + ".unique.mates.fasta"
+                with open(mates, "r") as mate_in:
+                    read_map, keys = predcache.collapse_pairs(
+                            fasta_functions.paired_reader(fin, mate_in),
+                            reverse, unique_fasta, unique_mates)
+            else:
+                read_map, keys = predcache.collapse(
+                        fasta_functions.fastx_reader(fin), reverse, unique_fasta)
+        cache = None
+        cached = [None] * len(keys)
+        score_input = unique_fasta
+        score_mates = unique_mates
+        if cache_size > 0:
+            cache = predcache.PredictionCache(
+                    os.path.join(model_dir, "predict-cache.txt"),
+                    predcache.model_id(models + pattern_files + cascade_files,
+                        kmer, reverse, cascade_threshold),
+                    cache_size)
+            cached = [cache.get(key) for key in keys]
+            score_input = prefix + ".misses.fasta"
+            with open(unique_fasta, "r") as fin:
+                with open(score_input, "w") as fout:
+                    for j, (name, seq, _) in enumerate(fasta_functions.fastx_reader(fin)):
+                        if cached[j] is None:
+                            fout.write(">{}\n{}\n".format(name, seq))
+            if paired:
+                score_mates = prefix + ".misses.mates.fasta"
+                with open(unique_mates, "r") as fin:
+                    with open(score_mates, "w") as fout:
+                        for j, (name, seq, _) in enumerate(fasta_functions.fastx_reader(fin)):
+                            if cached[j] is None:
+                                fout.write(">{}\n{}\n".format(name, seq))
+        num_scored = sum(1 for c in cached if c is None)
+        print('''Reads:          {reads}
+Unique reads:   {unique}
+Cache hits:     {hits}
+Reads scored:   {scored}'''.format(reads=len(read_map), unique=len(keys),
+            hits=len(keys) - num_scored, scored=num_scored))
+        sys.stdout.flush()
+        scored_preds = score(score_input, prefix + ".unique", score_mates)
+        if cache is None:
+            unique_preds = scored_preds
+        else:
+            # Merge cached and freshly scored predictions in unique order
+            unique_preds = prefix + ".unique.all.preds.vw"
+            with open(scored_preds, "r") as sin:
+                with open(unique_preds, "w") as uout:
+                    for j, prediction in enumerate(cached):
+                        if prediction is None:
+                            prediction = sin.readline()
+                            cache.put(keys[j], prediction)
+                        uout.write(prediction)
+            cache.save()
+            os.remove(score_input)
+            if paired:
+                os.remove(score_mates)
+        predcache.expand(unique_preds, read_map, prediction_file)
+        os.remove(unique_fasta)
+        if paired:
+            os.remove(unique_mates)
+    else:
+        score(fasta, prefix, mates)
+    if keep is not None:
+        # Dropped reads keep their place in the output as unclassified
+        readfilter.restore_dropped(prediction_file, keep,
+                unclassified_vw_line(read_dico(dico)))
+        os.remove(filtered_fasta)
+        if paired:
+            os.remove(filtered_mates)
 
     # Convert back to standard taxonomic IDs instead of IDs
     vw_class_to_taxid(prediction_file, dico, prefix + '.preds.taxid')
@@ -513,6 +1412,183 @@ Total wall clock runtime (sec): {s}
     return (prefix + '.preds.taxid')
 
 
+def predict_stream(model_dir, test_input, predict_dir, args):
+    '''Predicts FASTA/FASTQ reads streamed from a file, named pipe or stdin
+    ("-"), writing taxid predictions to stdout as each mini-batch of reads
+    is scored. The output has the same format as the .preds.taxid file of
+    predict. Progress and vw logs go to stderr and predict_dir (a temporary
+    directory if None).
+
+    Unpacking args:
+        kmer (int):         size of k-mers used
+        stream_batch (int): number of reads per mini-batch; output is
+                            flushed after each one, and at most
+                            STREAM_PENDING mini-batches are in flight
+    '''
+    # Unpack args
+    kmer = args.kmer
+    reverse = args.reverse_complement
+    stream_batch = args.stream_batch
+    # Finish unpacking args
+
+    if get_ensemble_members(model_dir):
+        raise ValueError("Streaming predict does not support ensemble models")
+    model = get_final_model(model_dir)
+    dico_file = os.path.join(model_dir, "vw-dico.txt")
+    pattern_file = os.path.join(model_dir, "patterns.txt")
+    starttime = datetime.now()
+    eprint(
+    '''================================================
+Streaming prediction using Opal + vowpal-wabbit
+{:%Y-%m-%d %H:%M:%S}
+'''.format(starttime) + '''
+k-mer length:   {kmer}
+mini-batch:     {stream_batch}
+------------------------------------------------
+Input:          {test_input}
+Model used:     {model}
+Dict used:      {dico}
+LDPC patterns:  {pattern_file}
+reverse-complements: {reverse}
+------------------------------------------------'''.format(
+    kmer=kmer,
+    stream_batch=stream_batch,
+    test_input=test_input,
+    model=model,
+    dico=dico_file,
+    pattern_file=pattern_file,
+    reverse=reverse)
+    )
+    if predict_dir:
+        safe_makedirs(predict_dir)
+        log_dir = predict_dir
+    else:
+        log_dir = tempfile.mkdtemp(prefix="opal-stream-")
+    dico = read_dico(dico_file)
+    unclassified = unclassified_vw_line(dico)
+    pattern_getters = fasta2skm.read_pattern_getters(pattern_file, kmer)
+    read_filter = make_read_filter(args, kmer, len(pattern_getters), reverse)
+
+    vw_param_list = ["vw", "-t",
+        "-i", model,
+        "--probabilities",
+        "-p", "/dev/stdout"]
+    vwps_log = os.path.join(log_dir, "stream_vwps.log")
+    vw = vwdriver.VWDriver(vw_param_list, vwps_log, stdout=subprocess.PIPE,
+            echo=False, env=my_env)
+    try:
+        # The reader thread converts vw's predictions as they arrive, and
+        # flushes stdout at the end of each mini-batch. Reads dropped by the
+        # read filter have no vw prediction and are output as unclassified.
+        batch_keeps = Queue.Queue()
+        pending = threading.Semaphore(STREAM_PENDING)
+        reader_errors = []
+        def read_predictions():
+            try:
+                header = True # the header line comes before the first prediction
+                for keep in iter(batch_keeps.get, None):
+                    lines = [vw.stdout.readline() if kept else unclassified
+                            for kept in keep]
+                    for out_line in vw_lines_to_taxid(lines, dico, header):
+                        sys.stdout.write(out_line)
+                    header = False
+                    sys.stdout.flush()
+                    pending.release()
+            except Exception as e:
+                reader_errors.append(e)
+                pending.release()
+                # keep draining vw so that it can exit
+                for _ in vw.stdout:
+                    pass
+        reader = threading.Thread(target=read_predictions)
+        reader.daemon = True
+        reader.start()
+
+        if test_input == "-":
+            input_file = sys.stdin
+        else:
+            input_file = open(test_input, "r")
+        num_reads = 0
+        records = fasta_functions.fastx_reader(input_file)
+        while True:
+            batch = list(itertools.islice(records, stream_batch))
+            if not batch:
+                break
+            pending.acquire()
+            if reader_errors:
+                break
+            keep = []
+            for _, seq, qual in batch:
+                if read_filter is not None:
+                    seq = read_filter.apply(seq, qual)
+                keep.append(seq is not None)
+                if seq is not None:
+                    vw.write(fasta2skm.skm_lines([pattern_getters], seq, kmer,
+                        reverse, 1)[0])
+            vw.flush()
+            batch_keeps.put(keep)
+            num_reads += len(batch)
+        batch_keeps.put(None)
+        if input_file is not sys.stdin:
+            input_file.close()
+        vw.close()
+    finally:
+        vw.abort()
+    reader.join()
+    if reader_errors:
+        raise RuntimeError("Reading vowpal_wabbit predictions failed: {}".format(reader_errors[0]))
+    eprint(vw.report())
+    if read_filter is not None:
+        eprint(read_filter.report())
+    eprint('''------------------------------------------------
+Reads predicted:    {n}
+Total wall clock runtime (sec): {s}
+================================================'''.format(
+    n=num_reads,
+    s=(datetime.now() - starttime).total_seconds()))
+    if not predict_dir:
+        shutil.rmtree(log_dir)
+    return 0
+
+
+def stage_params(args, names, **extra):
+    '''The values of the named arguments, plus extra, as the parameters of
+    a simulate stage manifest'''
+    params = dict((name, getattr(args, name)) for name in names)
+    params.update(extra)
+    return params
+
+def run_stage(stage, stage_dir, inputs, params, upstream, force, run):
+    '''Runs a stage of simulate by calling run(), which returns the files the
+    stage produced, unless stage_dir holds a completed earlier run with the
+    same input checksums, parameters and upstream stages (see
+    util/stages.py), or force is set.
+
+    Returns the stage manifest, whose "outputs" lists the produced files.
+    '''
+    m = stages.manifest(stage, inputs, params, upstream, __version__,
+            stages.load(stage_dir))
+    if not force and stages.is_current(stage_dir, m):
+        print("Stage {} is up to date in {}; skipping it".format(stage, stage_dir))
+        sys.stdout.flush()
+        return stages.load(stage_dir)
+    stages.invalidate(stage_dir)
+    outputs = run()
+    return stages.record(stage_dir, m, outputs)
+
+def train_outputs(model_dir):
+    '''The files of a trained model in model_dir: the dictionary, and each
+    member's (and the cascade model's) final model and patterns'''
+    outputs = [os.path.join(model_dir, "vw-dico.txt")]
+    model_dirs = get_ensemble_members(model_dir) or [model_dir]
+    cascade_dir = os.path.join(model_dir, "cascade")
+    if os.path.isdir(cascade_dir):
+        model_dirs.append(cascade_dir)
+    for member_dir in model_dirs:
+        outputs += [get_final_model(member_dir),
+                os.path.join(member_dir, "patterns.txt")]
+    return outputs
+
 def parse_extra(parser, namespace):
     namespaces = []
     extra = namespace.extra
@@ -563,16 +1639,118 @@ def main(argv):
             type=int, default=31)
     lambda1_arg = ArgClass("--lambda1", help="VW model lambda1 training parameter", type=float, default=0.)
     lambda2_arg = ArgClass("--lambda2", help="VW model lambda2 training parameter", type=float, default=0.)
+    processes_arg = ArgClass("--processes", help="""Draw fragments with this
+            many worker processes. Each fasta record then gets its own
+            random stream, so results do not depend on the number of
+            workers (but differ from the default serial drawing)""",
+            type=int, default=None)
+    ensemble_arg = ArgClass("--ensemble", help="""Number of models with
+            independently drawn LDPC patterns to train concurrently on the
+            same fragments; predictions average their probabilities""",
+            type=int, default=1)
+    ldpc_seed_arg = ArgClass("--ldpc-seed", help="""Seed for drawing the
+            LDPC patterns (random if not set)""", type=int, default=None)
+    design_candidates_arg = ArgClass("--design-candidates", help="""Draw
+            this many candidate LDPC pattern sets and keep the one most
+            sensitive to substitution errors (0 keeps the first draw)""",
+            type=int, default=0)
+    error_rate_arg = ArgClass("--error-rate", help="""Substitution error
+            rate at which candidate pattern sets are scored""",
+            type=float, default=0.1)
+    max_memory_arg = ArgClass("--max-memory", help="""Memory budget for
+            training, e.g. 32G or 500M (a bare number is in GiB). The total
+            coverage (coverage x num-batches) is split into as many batches
+            as needed for each batch to fit.""", default=None)
+    dedup_arg = ArgClass("--dedup", help="""Featurize and score each distinct
+            read sequence once (strand-canonical with -r) and copy the
+            prediction to every identical read""", action="store_true")
+    cache_size_arg = ArgClass("--cache-size", help="""Keep an LRU cache of up
+            to this many sequence predictions in the model directory, reused
+            by later predict runs with the same model (0 disables; implies
+            --dedup)""", type=int, default=0)
+    trim_quality_arg = ArgClass("--trim-quality", help="""Trim FASTQ reads
+            from the first window whose mean quality is below this (0
+            disables; predicted reads only, as training fragments have no
+            qualities)""", type=int, default=0)
+    trim_window_arg = ArgClass("--trim-window", help="""Window width for
+            --trim-quality""", type=int, default=4)
+    max_n_fraction_arg = ArgClass("--max-n-fraction", help="""Drop reads
+            with a larger fraction of Ns (1 disables)""", type=float,
+            default=1.0)
+    min_length_arg = ArgClass("--min-length", help="""Drop reads shorter
+            than this after trimming""", type=int, default=0)
+    min_complexity_arg = ArgClass("--min-complexity", help="""Drop reads
+            whose trinucleotide Shannon entropy, in bits (at most 6), is
+            below this (0 disables)""", type=float, default=0.)
+    resume_arg = ArgClass("--resume", help="""Continue training from the
+            last complete batch checkpoint in the model directory""",
+            action="store_true")
+    workers_arg = ArgClass("--workers", help="""Number of vw allreduce
+            workers to run on this host, each learning from its own shard of
+            every batch and averaging weights at the end of each pass""",
+            type=int, default=1)
+    span_server_arg = ArgClass("--span-server", help="""Host of a running
+            vw spanning_tree daemon coordinating the workers (by default one
+            is started locally); needed when training across hosts""",
+            default=None)
+    span_port_arg = ArgClass("--span-port", help="""Port of the
+            spanning_tree daemon""", type=int, default=26543)
+    total_workers_arg = ArgClass("--total-workers", help="""Number of
+            allreduce workers across all hosts (defaults to --workers).
+            Every host must use the same options, in particular the same
+            --ldpc-seed, --design-candidates, --error-rate and
+            --hierarchical-weight, so that they draw the same LDPC
+            patterns""",
+            type=int, default=None)
+    holdout_coverage_arg = ArgClass("--holdout-coverage", help="""Draw
+            hold-out fragments at this coverage, score them after every
+            batch and keep the best model (0 disables)""", type=float,
+            default=0.)
+    patience_arg = ArgClass("--patience", help="""With --holdout-coverage,
+            stop once accuracy has not improved for this many batches""",
+            type=int, default=3)
+    tolerance_arg = ArgClass("--tolerance", help="""With
+            --holdout-coverage, the smallest accuracy gain counted as an
+            improvement""", type=float, default=0.001)
+    taxon_fragments_arg = ArgClass("--taxon-fragments", help="""Draw this
+            many training fragments per taxid in each batch, split between
+            its records by length, instead of covering every record
+            --coverage times (0 disables)""", type=int, default=0)
+    taxon_max_coverage_arg = ArgClass("--taxon-max-coverage", help="""With
+            --taxon-fragments, draw at most this coverage of a taxid's
+            records (0 disables)""", type=float, default=0.)
+    taxon_min_arg = ArgClass("--taxon-min", help="""With --taxon-fragments,
+            fragments per taxid drawn regardless of
+            --taxon-max-coverage""", type=int, default=0)
+    taxon_weight_arg = ArgClass("--taxon-weight", help="""With
+            --taxon-fragments, give each taxid's examples the importance
+            weight taxon-fragments / fragments drawn, so that capped taxids
+            weigh the same""", action="store_true")
+    cascade_hashes_arg = ArgClass("--cascade-hashes", help="""Also train a
+            cheap model on only the first this many LDPC patterns, for
+            predict --cascade-threshold (0 disables)""", type=int, default=0)
+    cascade_threshold_arg = ArgClass("--cascade-threshold", help="""Score
+            reads with the cheap cascade model first and with the full model
+            only if the top class probability is below this (0 disables)""",
+            type=float, default=0.)
+    first_worker_arg = ArgClass("--first-worker", help="""Global index of
+            this host's first worker when training across hosts""",
+            type=int, default=0)
 
 
     subparsers = parser.add_subparsers(help="sub-commands", dest="mode")
 
+    parser_index = subparsers.add_parser("index", help="Pack a reference fasta file into a memory-mapped 2-bit sequence store used by frag and train",
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_index.add_argument("ref_dir", help="Input directory for reference data")
+
     parser_frag = subparsers.add_parser("frag", help="Fragment a fasta file into substrings for training/testing",
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_frag.add_argument("test_dir", help="Input directory for test data")
     parser_frag.add_argument("frag_dir", help="Output directory for fasta fragments")
     parser_frag.add_argument(*frag_length_arg.args, **frag_length_arg.kwargs)
     parser_frag.add_argument(*coverage_arg.args, **coverage_arg.kwargs)
+    parser_frag.add_argument(*processes_arg.args, **processes_arg.kwargs)
 
     parser_train = subparsers.add_parser("train", help="Train a Vowpal Wabbit model using Opal hashes",
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -590,12 +1768,53 @@ def main(argv):
     parser_train.add_argument(*bits_arg.args, **bits_arg.kwargs)
     parser_train.add_argument(*lambda1_arg.args, **lambda1_arg.kwargs)
     parser_train.add_argument(*lambda2_arg.args, **lambda2_arg.kwargs)
+    parser_train.add_argument(*processes_arg.args, **processes_arg.kwargs)
+    parser_train.add_argument(*ensemble_arg.args, **ensemble_arg.kwargs)
+    parser_train.add_argument(*ldpc_seed_arg.args, **ldpc_seed_arg.kwargs)
+    parser_train.add_argument(*design_candidates_arg.args, **design_candidates_arg.kwargs)
+    parser_train.add_argument(*error_rate_arg.args, **error_rate_arg.kwargs)
+    parser_train.add_argument(*max_memory_arg.args, **max_memory_arg.kwargs)
+    parser_train.add_argument(*max_n_fraction_arg.args, **max_n_fraction_arg.kwargs)
+    parser_train.add_argument(*min_length_arg.args, **min_length_arg.kwargs)
+    parser_train.add_argument(*min_complexity_arg.args, **min_complexity_arg.kwargs)
+    parser_train.add_argument(*resume_arg.args, **resume_arg.kwargs)
+    parser_train.add_argument(*workers_arg.args, **workers_arg.kwargs)
+    parser_train.add_argument(*span_server_arg.args, **span_server_arg.kwargs)
+    parser_train.add_argument(*span_port_arg.args, **span_port_arg.kwargs)
+    parser_train.add_argument(*total_workers_arg.args, **total_workers_arg.kwargs)
+    parser_train.add_argument(*first_worker_arg.args, **first_worker_arg.kwargs)
+    parser_train.add_argument(*holdout_coverage_arg.args, **holdout_coverage_arg.kwargs)
+    parser_train.add_argument(*patience_arg.args, **patience_arg.kwargs)
+    parser_train.add_argument(*tolerance_arg.args, **tolerance_arg.kwargs)
+    parser_train.add_argument(*taxon_fragments_arg.args, **taxon_fragments_arg.kwargs)
+    parser_train.add_argument(*taxon_max_coverage_arg.args, **taxon_max_coverage_arg.kwargs)
+    parser_train.add_argument(*taxon_min_arg.args, **taxon_min_arg.kwargs)
+    parser_train.add_argument(*taxon_weight_arg.args, **taxon_weight_arg.kwargs)
+    parser_train.add_argument(*cascade_hashes_arg.args, **cascade_hashes_arg.kwargs)
 
     parser_predict = subparsers.add_parser("predict", help="Predict metagenomic classifications given a Opal/VW model",
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_predict.add_argument("model_dir", help="Input directory for VW model")
     parser_predict.add_argument("test_dir", help="Input directory for already fragmented test data")
-    parser_predict.add_argument("predict_dir", help="Output directory for predictions")
+    parser_predict.add_argument("predict_dir", nargs="?", default=None, help="Output directory for predictions (optional with --stream, where it receives the vw log)")
+    parser_predict.add_argument("--stream", help="""Treat test_dir as a
+            FASTA/FASTQ file, named pipe or "-" for stdin, and write taxid
+            predictions to stdout as each mini-batch of reads is scored""",
+            action="store_true")
+    parser_predict.add_argument(*dedup_arg.args, **dedup_arg.kwargs)
+    parser_predict.add_argument(*cache_size_arg.args, **cache_size_arg.kwargs)
+    parser_predict.add_argument(*trim_quality_arg.args, **trim_quality_arg.kwargs)
+    parser_predict.add_argument(*trim_window_arg.args, **trim_window_arg.kwargs)
+    parser_predict.add_argument(*max_n_fraction_arg.args, **max_n_fraction_arg.kwargs)
+    parser_predict.add_argument(*min_length_arg.args, **min_length_arg.kwargs)
+    parser_predict.add_argument(*min_complexity_arg.args, **min_complexity_arg.kwargs)
+    parser_predict.add_argument("--paired", help="""test_dir holds paired-end
+            read files named alike but for _R1/_R2 (or _1./_2.); both mates
+            of a pair are classified together as one example""",
+            action="store_true")
+    parser_predict.add_argument(*cascade_threshold_arg.args, **cascade_threshold_arg.kwargs)
+    parser_predict.add_argument("--stream-batch", help="""Number of reads
+            per mini-batch in --stream mode""", type=int, default=1000)
     parser_predict.add_argument(*reverse_complement_arg.args, **reverse_complement_arg.kwargs)
     parser_predict.add_argument(*kmer_arg.args, **kmer_arg.kwargs)
 
@@ -612,6 +1831,9 @@ ranges''', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_simulate.add_argument("train_dir", help="Input directory for train data")
     parser_simulate.add_argument("out_dir", help="Output directory for all steps")
     parser_simulate.add_argument("--do-not-fragment", help="If set, will use test_dir fasta files as is without fragmenting", action="store_true")
+    parser_simulate.add_argument("--force", help="""Rerun every stage, even
+            those whose manifest shows they are up to date""",
+            action="store_true")
     parser_simulate.add_argument(*frag_length_arg.args, **frag_length_arg.kwargs)
     parser_simulate.add_argument(*coverage_arg.args, **coverage_arg.kwargs)
     parser_simulate.add_argument(*kmer_arg.args, **kmer_arg.kwargs)
@@ -624,10 +1846,51 @@ ranges''', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_simulate.add_argument(*bits_arg.args, **bits_arg.kwargs)
     parser_simulate.add_argument(*lambda1_arg.args, **lambda1_arg.kwargs)
     parser_simulate.add_argument(*lambda2_arg.args, **lambda2_arg.kwargs)
+    parser_simulate.add_argument(*processes_arg.args, **processes_arg.kwargs)
+    parser_simulate.add_argument(*ensemble_arg.args, **ensemble_arg.kwargs)
+    parser_simulate.add_argument(*ldpc_seed_arg.args, **ldpc_seed_arg.kwargs)
+    parser_simulate.add_argument(*design_candidates_arg.args, **design_candidates_arg.kwargs)
+    parser_simulate.add_argument(*error_rate_arg.args, **error_rate_arg.kwargs)
+    parser_simulate.add_argument(*max_memory_arg.args, **max_memory_arg.kwargs)
+    parser_simulate.add_argument(*dedup_arg.args, **dedup_arg.kwargs)
+    parser_simulate.add_argument(*cache_size_arg.args, **cache_size_arg.kwargs)
+    parser_simulate.add_argument(*trim_quality_arg.args, **trim_quality_arg.kwargs)
+    parser_simulate.add_argument(*trim_window_arg.args, **trim_window_arg.kwargs)
+    parser_simulate.add_argument(*max_n_fraction_arg.args, **max_n_fraction_arg.kwargs)
+    parser_simulate.add_argument(*min_length_arg.args, **min_length_arg.kwargs)
+    parser_simulate.add_argument(*min_complexity_arg.args, **min_complexity_arg.kwargs)
+    parser_simulate.add_argument(*resume_arg.args, **resume_arg.kwargs)
+    parser_simulate.add_argument(*workers_arg.args, **workers_arg.kwargs)
+    parser_simulate.add_argument(*span_server_arg.args, **span_server_arg.kwargs)
+    parser_simulate.add_argument(*span_port_arg.args, **span_port_arg.kwargs)
+    parser_simulate.add_argument(*total_workers_arg.args, **total_workers_arg.kwargs)
+    parser_simulate.add_argument(*first_worker_arg.args, **first_worker_arg.kwargs)
+    parser_simulate.add_argument(*holdout_coverage_arg.args, **holdout_coverage_arg.kwargs)
+    parser_simulate.add_argument(*patience_arg.args, **patience_arg.kwargs)
+    parser_simulate.add_argument(*tolerance_arg.args, **tolerance_arg.kwargs)
+    parser_simulate.add_argument(*taxon_fragments_arg.args, **taxon_fragments_arg.kwargs)
+    parser_simulate.add_argument(*taxon_max_coverage_arg.args, **taxon_max_coverage_arg.kwargs)
+    parser_simulate.add_argument(*taxon_min_arg.args, **taxon_min_arg.kwargs)
+    parser_simulate.add_argument(*taxon_weight_arg.args, **taxon_weight_arg.kwargs)
+    parser_simulate.add_argument(*cascade_hashes_arg.args, **cascade_hashes_arg.kwargs)
+    parser_simulate.add_argument(*cascade_threshold_arg.args, **cascade_threshold_arg.kwargs)
 
     args = parser.parse_args(argv)
 
-    print(args)
+    streaming = args.mode == "predict" and args.stream
+    if args.mode == "predict" and not streaming and args.predict_dir is None:
+        parser.error("predict_dir is required unless --stream is set")
+    if streaming and args.paired:
+        parser.error("--paired reads two files and cannot be used with --stream")
+    if streaming and args.cascade_threshold > 0:
+        parser.error("--cascade-threshold cannot be used with --stream")
+    if streaming and (args.dedup or args.cache_size > 0):
+        parser.error("--dedup and --cache-size cannot be used with --stream")
+    if streaming:
+        # stdout carries the predictions
+        eprint(args)
+    else:
+        print(args)
     sys.stdout.flush()
 
     mode = args.mode
@@ -640,25 +1903,52 @@ ranges''', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         frag_dir = os.path.join(output_dir, '1frag')
         model_dir = os.path.join(output_dir, '2model')
         predict_dir = os.path.join(output_dir, '3predict')
+        # Each stage is skipped if its manifest shows it already ran with
+        # the same inputs, arguments and upstream stages
+        force = args.force
+        train_fasta, train_taxids = get_fasta_and_taxid(args.train_dir)
+        test_fasta, test_taxids = get_fasta_and_taxid(args.test_dir)
+        upstream = []
         if args.do_not_fragment:
-            train(args.train_dir, model_dir, args)
-            pf = predict(model_dir, args.test_dir, predict_dir, args)
-            _, rf = get_fasta_and_taxid(args.test_dir)
+            predict_input_dir = args.test_dir
         else:
-            frag(args.test_dir, frag_dir, args)
+            def run_frag():
+                frag(args.test_dir, frag_dir, args)
+                return get_fasta_and_taxid(frag_dir)
+            upstream.append(run_stage("frag", frag_dir,
+                {"fasta": test_fasta, "taxids": test_taxids},
+                stage_params(args, FRAG_STAGE_ARGS, seed=FRAG_SEED,
+                    parallel_draws=bool(args.processes)),
+                [], force, run_frag))
+            predict_input_dir = frag_dir
+        def run_train():
             train(args.train_dir, model_dir, args)
-            pf = predict(model_dir, frag_dir, predict_dir, args)
-            _, rf = get_fasta_and_taxid(frag_dir)
+            return train_outputs(model_dir)
+        upstream.append(run_stage("train", model_dir,
+            {"fasta": train_fasta, "taxids": train_taxids},
+            stage_params(args, TRAIN_STAGE_ARGS, seed=TRAIN_SEED,
+                parallel_draws=bool(args.processes)),
+            [], force, run_train))
+        def run_predict():
+            return [predict(model_dir, predict_input_dir, predict_dir, args)]
+        predict_fasta, rf = get_fasta_and_taxid(predict_input_dir)
+        pf = run_stage("predict", predict_dir, {"fasta": predict_fasta},
+            stage_params(args, PREDICT_STAGE_ARGS), upstream, force,
+            run_predict)["outputs"][0]
 
         print("Evaluation reference file: " + rf)
         sys.stdout.flush()
         evaluate_predictions(rf, pf)
         print("Total full sim wall clock runtime (sec): {}".format(
             (datetime.now() - fullstarttime).total_seconds()))
+    elif mode == "index":
+        index(args.ref_dir, args)
     elif mode == "frag":
         frag(args.test_dir, args.frag_dir, args)
     elif mode == "train":
         train(args.train_dir, args.model_dir, args)
+    elif mode == "predict" and streaming:
+        predict_stream(args.model_dir, args.test_dir, args.predict_dir, args)
     elif mode == "predict":
         predict(args.model_dir, args.test_dir, args.predict_dir, args)
     elif mode == "eval":
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''
+Checkpoint helpers for resumable multi-batch Opal training.
+
+After each completed batch, the checkpoint directory holds the Vowpal Wabbit
+--save_resume model (one per member when training an ensemble), a snapshot
+of the taxid <--> vw class dictionary, and a small JSON state file recording
+the last finished batch, its seed and the Python RNG state. Every file is
+written under a temporary name and renamed into place, so an interrupted run
+never leaves a half-written checkpoint.
+'''
+
+from __future__ import print_function
+import json
+import os
+import shutil
+
+STATE_FILE = "checkpoint.json"
+
+def atomic_copy(src, dst):
+    '''Copies src to dst through a temporary file and a rename'''
+    tmp = dst + ".tmp"
+    shutil.copyfile(src, tmp)
+    os.rename(tmp, dst)
+
+def atomic_write_json(obj, dst):
+    '''Writes obj as JSON to dst through a temporary file and a rename'''
+    tmp = dst + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, dst)
+
+def batch_paths(checkpoint_dir, batch, members=1):
+    '''Returns the ([models], dico) checkpoint file names of a batch'''
+    prefix = os.path.join(checkpoint_dir, "batch-{}".format(batch))
+    if members == 1:
+        models = [prefix + ".model"]
+    else:
+        models = [prefix + ".member-{}.model".format(j) for j in range(members)]
+    return (models, prefix + ".dico")
+
+def best_paths(checkpoint_dir, members=1):
+    '''Returns the file names of copies of the best models so far'''
+    prefix = os.path.join(checkpoint_dir, "best")
+    if members == 1:
+        return [prefix + ".model"]
+    return [prefix + ".member-{}.model".format(j) for j in range(members)]
+
+def save(checkpoint_dir, batch, seed, model_tmps, dico, rng_state, params,
+        **extra):
+    '''Records batch as complete.
+
+    model_tmps (list):  models written by vw for this batch, one per member;
+                        renamed into the checkpoint directory
+    dico (string):      current dictionary file; a snapshot is kept
+    rng_state (tuple):  random.getstate() after the batch
+    params (dict):      training parameters the checkpoint is only valid for
+    extra:              any further JSON-serializable progress to record
+
+    Returns the new state dictionary.
+    '''
+    models, dico_snapshot = batch_paths(checkpoint_dir, batch, len(model_tmps))
+    for model_tmp, model in zip(model_tmps, models):
+        os.rename(model_tmp, model)
+    atomic_copy(dico, dico_snapshot)
+    previous = load(checkpoint_dir)
+    state = {
+        "batch": batch,
+        "seed": seed,
+        "models": [os.path.basename(model) for model in models],
+        "dico": os.path.basename(dico_snapshot),
+        "rng_state": rng_state,
+        "params": params}
+    state.update(extra)
+    atomic_write_json(state, os.path.join(checkpoint_dir, STATE_FILE))
+    # Only the latest checkpoint is needed to resume
+    if previous is not None and previous["batch"] != batch:
+        for path in previous["models"] + [previous["dico"]]:
+            if os.path.isfile(path):
+                os.remove(path)
+    return load(checkpoint_dir)
+
+def load(checkpoint_dir):
+    '''Returns the latest checkpoint state, or None if there is none.
+
+    The models and dico entries are returned as full paths and rng_state is
+    converted back into the tuple form expected by random.setstate.'''
+    state_file = os.path.join(checkpoint_dir, STATE_FILE)
+    if not os.path.isfile(state_file):
+        return None
+    with open(state_file, 'r') as f:
+        state = json.load(f)
+    state["models"] = [os.path.join(checkpoint_dir, m) for m in state["models"]]
+    state["dico"] = os.path.join(checkpoint_dir, state["dico"])
+    version, internal, gauss_next = state["rng_state"]
+    state["rng_state"] = (version, tuple(internal), gauss_next)
+    return state
+
+def clear(checkpoint_dir):
+    '''Removes any checkpoint state left by an earlier run'''
+    if os.path.isdir(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
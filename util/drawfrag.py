@@ -10,44 +10,148 @@ import argparse
 import os
 import sys
 import random
+import hashlib
+import itertools
+import multiprocessing
 
 from fasta_functions import fasta_reader, check_acgt
+import seqstore
+
+def draw_fragments(rng, seq, k, desired_coverage, atgc=False):
+    '''Draws random substrings of size k from seq until they cover
+    desired_coverage bases, giving up after 10*len(seq) tries.
+
+    rng:    source of randint; either the random module or a random.Random
+    '''
+    fragments = []
+    coverage = 0
+    if len(seq)<k or desired_coverage <= 0:
+        return fragments
+    # A seqstore.StoredSequence is decoded once here rather than once per
+    # fragment; a str is returned as is
+    seq = str(seq)
+    try_num = 0
+    while coverage < desired_coverage:
+        try_num = try_num+1
+        pos = rng.randint(0,len(seq) - k)
+        sample = seq[pos:pos+k]
+        if atgc and not check_acgt(sample):
+            pass
+        else:
+            coverage = coverage + k
+            fragments.append(sample)
+        if try_num > 10*len(seq):
+            break
+    return fragments
+
+def record_seed(seed, index):
+    '''Derives the seed of a record's own random stream from the run seed and
+    the record index, so that its draws do not depend on the other records'''
+    digest = hashlib.sha256("{}:{}".format(seed, index)).hexdigest()
+    return int(digest[:16], 16)
+
+def draw_record(task):
+    '''Draws the fragments of one record with its own random stream. Defined
+    at module level so that it can run in a process pool.'''
+    index, seq, k, desired_coverage, atgc, seed = task
+    # seq is a str, or a seqstore.StoredSequence that is only decoded in
+    # the worker (and not at all if nothing is drawn from it)
+    rng = random.Random(record_seed(seed, index))
+    return draw_fragments(rng, seq, k, desired_coverage, atgc)
 
 def main_not_commandline(args):
     '''All the main code except for the parser'''
-    input_file = open(args.input, 'r')
     output_file = open(args.output, 'w')
-    taxid_infile = open(args.taxids, 'r')
     gi2taxid_outfile = open(args.gi2taxid, 'w')
     k = args.size
 
-    if args.seed:
-        random.seed(args.seed)
+    if args.store:
+        # Records are decoded from the memory-mapped store as they are drawn
+        # from, with the same random draws as from the fasta it was indexed
+        # from
+        store = seqstore.open_store(args.store)
+        def sequences():
+            for name, tlabel, seq in store:
+                yield (name.split()[0], tlabel, seq)
+    else:
+        input_file = open(args.input, 'r')
+        taxid_infile = open(args.taxids, 'r')
+        def sequences():
+            for name, seq in fasta_reader(input_file):
+                tlabel = taxid_infile.readline().rstrip('\n')
+                yield (name.split()[0], tlabel, seq)
+
+    # Bases to draw from each record: coverage times its length, or a given
+    # number of fragments
+    if args.fragments:
+        counts_file = open(args.fragments, 'r')
+        def records():
+            for firstname, tlabel, seq in sequences():
+                count = int(counts_file.readline() or 0)
+                yield (firstname, tlabel, seq, count * k)
+    else:
+        def records():
+            for firstname, tlabel, seq in sequences():
+                yield (firstname, tlabel, seq, args.coverage * len(seq))
+
+    if args.processes:
+        # Every record gets its own random stream derived from (seed, record
+        # index), so the output is the same for any number of workers
+        seed = args.seed
+        if seed is None:
+            seed = random.SystemRandom().randint(0, 2**31 - 1)
+        fragment_lists = parallel_draws(records(), k, args.atgc, seed,
+                args.processes)
+    else:
+        if args.seed:
+            random.seed(args.seed)
+        fragment_lists = (
+                (firstname, tlabel, draw_fragments(random, seq, k,
+                    desired_coverage, args.atgc))
+                for firstname, tlabel, seq, desired_coverage in records())
 
     read_num = 0
-    for name, seq in fasta_reader(input_file):
-        tlabel = taxid_infile.readline().rstrip('\n')
-        firstname = name.split()[0]
-        coverage = 0
-        desired_coverage = args.coverage * len(seq)
-        if len(seq)<k:
-            pass
-        else:
-            try_num = 0
-            while coverage < desired_coverage:
-                try_num = try_num+1
-                pos = random.randint(0,len(seq) - k)
-                sample = seq[pos:pos+k]
-                if args.atgc and not check_acgt(sample):
-                    pass
-                else:
-                    coverage = coverage + k
-                    read_num = read_num + 1
-                    output_file.write(">{}\n".format(read_num))
-                    output_file.write("{}\n".format(sample))
-                    gi2taxid_outfile.write("{}\t{}\n".format(firstname, tlabel))
-                if try_num > 10*len(seq):
-                    break
+    for firstname, tlabel, fragments in fragment_lists:
+        for sample in fragments:
+            read_num = read_num + 1
+            output_file.write(">{}\n".format(read_num))
+            output_file.write("{}\n".format(sample))
+            gi2taxid_outfile.write("{}\t{}\n".format(firstname, tlabel))
+    if not args.store:
+        input_file.close()
+        taxid_infile.close()
+    if args.fragments:
+        counts_file.close()
+    output_file.close()
+    gi2taxid_outfile.close()
+
+def parallel_draws(records, k, atgc, seed, processes):
+    '''Yields (firstname, tlabel, fragments) in record order, drawing the
+    fragments in a pool of processes. records yields (firstname, tlabel,
+    seq, desired_coverage), the last being the number of bases to draw. Records are handed out in windows so
+    that only a bounded number of sequences is held in memory.'''
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    window = max(processes, 1) * 16
+    index = 0
+    try:
+        while True:
+            chunk = list(itertools.islice(records, window))
+            if not chunk:
+                break
+            tasks = [(index + j, seq, k, desired_coverage, atgc, seed)
+                    for j, (_, _, seq, desired_coverage) in enumerate(chunk)]
+            index = index + len(chunk)
+            if pool is None:
+                results = [draw_record(task) for task in tasks]
+            else:
+                results = pool.map(draw_record, tasks,
+                        chunksize=max(1, len(tasks) // (processes * 4)))
+            for (firstname, tlabel, _, _), fragments in zip(chunk, results):
+                yield (firstname, tlabel, fragments)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
 
 def main(argv):
@@ -60,10 +164,13 @@ def main(argv):
     parser.add_argument('-l', '--size', help='size of drawn items [required]', type=int)
     parser.add_argument('-t', '--taxids', help='one-column file containing the taxid of each input sequence] [required]')
     parser.add_argument('-c', '--coverage', help='mean coverage value for drawing fragments [required]', type=float)
+    parser.add_argument('-n', '--fragments', help='one-column file giving the number of fragments to draw from each input sequence, used instead of -c')
     parser.add_argument('-g', '--gi2taxid', help='output gi2taxids file: two-column file containing genome ids and taxids of the drawn fragments [required]')
     parser.add_argument('-s', '--seed', help='value used to initialize the random seed (to use for reproducibility purposes; if not set, will be randomly initialized by Python', type=int)
+    parser.add_argument('--store', help='read the input sequences and taxids from a sequence store directory made by seqstore.py instead of -i and -t')
     parser.add_argument('-o', '--output', help='output sequence file [required]')
     parser.add_argument('--atgc', help='draw fragments made of ATCG only', action='store_true')
+    parser.add_argument('-p', '--processes', help='draw with this many worker processes, giving each input record its own random stream derived from the seed and record index (output does not depend on the number of workers)', type=int)
     
     args = parser.parse_args(argv)
     print(args)
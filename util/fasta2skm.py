@@ -13,8 +13,9 @@ import os
 import sys
 import operator
 import itertools
+import numpy as np
 
-from fasta_functions import fasta_reader, reverse_complement, get_all_substrings
+from fasta_functions import fasta_reader, paired_reader, reverse_complement, get_all_substrings
 
 def update_dictionary(labels, dico_file):
     '''Updates the dictionary file converting labels to vwid with an iterator over new labels'''
@@ -27,6 +28,7 @@ def update_dictionary(labels, dico_file):
                 vwid = int(vwid_str)
                 label2vwid[label] = vwid
                 vwidset.add(vwid)
+    original = dict(label2vwid)
     for line in labels:
         label = line.rstrip('\n')
         if label in label2vwid:
@@ -38,9 +40,14 @@ def update_dictionary(labels, dico_file):
                 vwid = max(vwidset)+1
             label2vwid[label] = vwid
             vwidset.add(vwid)
-    with open(dico_file, "w") as df:
-        for label, vwid in label2vwid.items():
-            df.write("{}\t{}\n".format(label, vwid))
+    # Only rewrite when labels were added, and do it atomically, so that
+    # concurrent readers of the same dictionary never see a partial file
+    if len(label2vwid) != len(original):
+        tmp_file = "{}.tmp{}".format(dico_file, os.getpid())
+        with open(tmp_file, "w") as df:
+            for label, vwid in label2vwid.items():
+                df.write("{}\t{}\n".format(label, vwid))
+        os.rename(tmp_file, dico_file)
     return label2vwid
 
 def main_generator(args):
@@ -48,6 +55,16 @@ def main_generator(args):
     
     Does not send to output.
     '''
+    for lines in ensemble_generator(args, [args.pattern]):
+        yield lines[0]
+
+def ensemble_generator(args, pattern_files):
+    '''Yields, for each input sequence, a list with one skm per pattern file
+    (None selects the contiguous k-mer).
+
+    The k-mers of each sequence are extracted once and shared by all the
+    pattern sets. args.pattern is ignored.
+    '''
     if not args.input or not args.kmer:
         raise ValueError("fasta2skm requires input and kmer arguments")
 
@@ -58,30 +75,53 @@ def main_generator(args):
         with open(args.taxid, 'r') as taxid_file:
             label2vwid = update_dictionary(taxid_file, args.dico)
 
-    # Reads in the pattern file
-    if args.pattern:
-        with open(args.pattern, 'r') as pattern_file:
-            file_contents = pattern_file.readlines()
-    else:
-        file_contents = None
-    pattern_getters = create_pattern_getters(file_contents, args.kmer)
+    # Reads in the pattern files
+    pattern_getters_list = [read_pattern_getters(pattern, args.kmer)
+            for pattern in pattern_files]
 
+    # Optional importance weights per taxid, e.g. from taxon-balanced
+    # sampling, go after the vw class
+    weights = getattr(args, "weights", None)
     if args.taxid:
         taxid_file = open(args.taxid, 'r')
-        labels = (label2vwid[l.rstrip('\n')] for l in taxid_file)
+        if weights:
+            labels = ("{} {:g}".format(label2vwid[t], weights.get(t, 1.0))
+                    for t in (l.rstrip('\n') for l in taxid_file))
+        else:
+            labels = (label2vwid[l.rstrip('\n')] for l in taxid_file)
     else:
         labels = itertools.repeat(1)
 
+    # With paired-end reads, the second mates come from args.mates and each
+    # pair becomes one example with the features of both mates
+    mates = getattr(args, "mates", None)
     with open(args.input, 'r') as input_file:
-        for _, seq in fasta_reader(input_file):
-            feature_list = gen_features(pattern_getters, seq, args.kmer)
-            if args.reverse:
-                feature_list.extend(gen_features(pattern_getters, reverse_complement(seq), args.kmer))
-            features = " ".join(feature_list)
-            yield '{} | {}\n'.format(labels.next(), features)
+        if mates:
+            with open(mates, 'r') as mate_file:
+                for (_, seq, _), (_, mate, _) in paired_reader(input_file, mate_file):
+                    yield skm_lines(pattern_getters_list, seq, args.kmer,
+                            args.reverse, labels.next(), mate)
+        else:
+            for _, seq in fasta_reader(input_file):
+                yield skm_lines(pattern_getters_list, seq, args.kmer,
+                        args.reverse, labels.next())
     if args.taxid:
         taxid_file.close()
 
+def skm_lines(pattern_getters_list, seq, kmer, reverse, label, mate=None):
+    '''Returns the skm line of seq (joined by the features of its mate, if
+    given) for each pattern set, extracting the k-mers (and reverse
+    complement k-mers if reverse) only once'''
+    kmers = get_all_substrings(seq, kmer)
+    if reverse:
+        kmers.extend(get_all_substrings(reverse_complement(seq), kmer))
+    if mate is not None:
+        kmers.extend(get_all_substrings(mate, kmer))
+        if reverse:
+            kmers.extend(get_all_substrings(reverse_complement(mate), kmer))
+    return ['{} | {}\n'.format(label, " ".join(gen_kmer_features(pattern_getters, kmers)))
+            for pattern_getters in pattern_getters_list]
+
 def main_not_commandline(args):
     '''All the main code except for the parser'''
     gen = main_generator(args)
@@ -107,19 +147,47 @@ def main(argv):
         (created if does not exist; possibly updated and overwritten if exists)
         (must be specified if --taxid option is used)
         (useless if --taxid option is not used)''')
+    parser.add_argument('-w', '--weights', help='two-column file giving an importance weight for the instances of each taxid (default 1)')
     parser.add_argument('-o', '--output', help='output file', default='-')
+    parser.add_argument('-m', '--mates', help='file containing the second mates of paired-end input sequences; each pair gives one instance with the features of both mates')
     parser.add_argument('-r', '--reverse', help='Take the reverse complements of sequences; fails if non-ACGT sequences provided', action='store_true')
     
     args = parser.parse_args(argv)
+    if args.weights:
+        args.weights = read_weights(args.weights)
     main_not_commandline(args)
 
+def read_weights(weights_file):
+    '''Reads a two-column taxid --> importance weight file'''
+    weights = {}
+    with open(weights_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                label, weight = line.split()[:2]
+                weights[label] = float(weight)
+    return weights
+
+
+def read_pattern_getters(pattern, kmer):
+    '''Reads in a pattern file (None selects the contiguous k-mer).
+
+    If ldpc.py left a binary index-array copy (.npy) next to the pattern
+    file that is at least as new, it is loaded instead of parsing the text.
+    '''
+    if not pattern:
+        return create_pattern_getters(None, kmer)
+    binary = os.path.splitext(pattern)[0] + ".npy"
+    if os.path.isfile(binary) and os.path.getmtime(binary) >= os.path.getmtime(pattern):
+        return pattern_getters_from_rows(np.load(binary).tolist(), kmer)
+    with open(pattern, 'r') as pattern_file:
+        file_contents = pattern_file.readlines()
+    return create_pattern_getters(file_contents, kmer)
 
 def create_pattern_getters(pattern_file_contents, kmer):
     '''Reads in the pattern file'''
     pattern_list = []
     if pattern_file_contents:
         num_hash, row_weight = [int(x) for x in pattern_file_contents[0].split()[:2]]
-        assert(kmer%row_weight ==0)
         for i in range(num_hash):
             row = [int(x) for x in pattern_file_contents[1+i].split()]
             assert(len(row)==row_weight)
@@ -127,12 +195,22 @@ def create_pattern_getters(pattern_file_contents, kmer):
     else:
         row = [x for x in range(kmer)]
         pattern_list.append(row)
+    return pattern_getters_from_rows(pattern_list, kmer)
+
+def pattern_getters_from_rows(pattern_list, kmer):
+    '''Turns rows of k-mer positions into functions picking them out'''
+    row_weight = len(pattern_list[0])
+    assert(kmer%row_weight ==0)
+    assert(all(len(row)==row_weight for row in pattern_list))
     pattern_getters = [operator.itemgetter(*pl) for pl in pattern_list]
     return pattern_getters
 
 def gen_features(pattern_getters, seq, k):
     '''Generates features from a pattern list and a sequence'''
-    kmers = get_all_substrings(seq, k)
+    return gen_kmer_features(pattern_getters, get_all_substrings(seq, k))
+
+def gen_kmer_features(pattern_getters, kmers):
+    '''Generates features from a pattern list and already extracted k-mers'''
     feature_list = ["".join(pat(kmer))+str(i) for kmer in kmers for i, pat in enumerate(pattern_getters)]
     return feature_list
 
@@ -2,6 +2,7 @@
 '''
 Some shared Python functions for Opal helper scripts.
 '''
+import itertools
 import re
 import string
 
@@ -10,12 +11,54 @@ def fasta_reader(f):
         
         Ignores quality score string of FASTQ file
     '''
+    for name, seq, _ in fastx_reader(f):
+        yield (name, seq)
+
+def fastx_reader(f):
+    '''Generator expression that returns (name, sequence, quality) tuples
+    from a FASTA or FASTQ file; quality is None for FASTA records.
+
+    The format is detected from the first line, so f can be a pipe.
+    '''
+    line = f.readline()
+    while line and not line.strip():
+        line = f.readline()
+    if line[:1] == '@':
+        return fastq_records(f, line)
+    return ((name, seq, None) for name, seq in fasta_records(f, line))
+
+def mate_name(name):
+    '''Name shared by the two mates of a read pair: the first word of the
+    record name, without a /1 or /2 suffix'''
+    words = name.split()
+    first = words[0] if words else ''
+    if len(first) > 2 and first[-2] == '/' and first[-1] in '12':
+        first = first[:-2]
+    return first
+
+def paired_reader(f1, f2):
+    '''Generator expression that returns the ((name, sequence, quality),
+    (name, sequence, quality)) mates of each read pair in the FASTA/FASTQ
+    files f1 and f2, read in lockstep.
+
+    Raises ValueError if the files hold different numbers of reads or the
+    names of a pair's mates do not match.
+    '''
+    pairs = itertools.izip_longest(fastx_reader(f1), fastx_reader(f2))
+    for index, (r1, r2) in enumerate(pairs):
+        if r1 is None or r2 is None:
+            raise ValueError("Paired read files hold different numbers of reads (read {} has no mate)".format(index + 1))
+        if mate_name(r1[0]) != mate_name(r2[0]):
+            raise ValueError("Mate names of read {} do not match: {} and {}".format(index + 1, r1[0], r2[0]))
+        yield (r1, r2)
+
+def fasta_records(f, line):
+    '''FASTA records of f, whose first line has already been read'''
     seq = ''
     name = ''
     ignore_line = False
     first_line = True
     while True:
-        line = f.readline()
         if line=='':
             if seq=='':
                 break
@@ -40,6 +83,34 @@ def fasta_reader(f):
                 pass
             else:
                 seq = seq + line.rstrip('\n')
+        line = f.readline()
+
+def fastq_records(f, line):
+    '''FASTQ records of f, whose first line has already been read. Sequence
+    and quality may be wrapped over several lines.'''
+    while line:
+        if not line.strip():
+            line = f.readline()
+            continue
+        if line[0] != '@':
+            raise ValueError("Malformed FASTQ record header: " + line.rstrip('\n'))
+        name = line[1:].rstrip('\n')
+        seq_parts = []
+        line = f.readline()
+        while line and line[0] != '+':
+            seq_parts.append(line.rstrip('\n'))
+            line = f.readline()
+        seq = ''.join(seq_parts)
+        qual_parts = []
+        qual_length = 0
+        while qual_length < len(seq):
+            line = f.readline()
+            if not line:
+                raise ValueError("Truncated FASTQ record: " + name)
+            qual_parts.append(line.rstrip('\n'))
+            qual_length += len(qual_parts[-1])
+        yield (name, seq, ''.join(qual_parts))
+        line = f.readline()
 
 trans = string.maketrans('ATGCatgc', 'TACGTACG')
 def reverse_complement(dna):
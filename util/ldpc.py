@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
 """
 Generates LDPC hash function locations for k-mers
+
+With -c, many candidate pattern sets are drawn and the one most sensitive
+to substitution errors (with the least positional overlap between patterns
+as the tie-breaker) is written; see design.
 """
 
 import numpy as np
 import argparse
+import multiprocessing
+import os
 import sys
 
-def ldpc(k, t, _m):
+# Number of error-sampled k-mers each candidate pattern set is scored on
+DESIGN_SAMPLES = 20000
+# Bytes of the temporary arrays sensitivity and overlap build at a time
+SCORE_CHUNK_BYTES = 1 << 24
+
+def ldpc(k, t, _m, seed=None):
     '''Generates a low density code matrix.
 
     k (int):        width of matrix / length of k-mer
@@ -16,6 +27,7 @@ def ldpc(k, t, _m):
                     (may not be exactly what is returned as the actual
                     height of the matrix is computed below, but the result
                     will be at least _m in height
+    seed (int):     seed for the random permutations (random if None)
     
     returns 0/1 matrix
     '''
@@ -25,18 +37,18 @@ def ldpc(k, t, _m):
     m = (int(np.ceil(_m*1.0/(k/t)) + 1)) * (k//t)
     w = m * t // k
 
-    H_basic = np.zeros((m//w, k), dtype=np.bool)
-    for i in range(m//w):
-        for j in range(i * t, (i + 1) * t):
-            H_basic[i, j] = 1
+    H_basic = np.zeros((m//w, k), dtype=bool)
+    H_basic[np.arange(k) // t, np.arange(k)] = True
 
-    H = H_basic.copy()
-    for p in range(w - 1):
-        perm_idx = np.random.permutation(k)
-        H = np.vstack((H, H_basic[:, perm_idx]))
+    # Draw all w - 1 column permutations at once and permute H_basic with
+    # each of them in one fancy-indexing step
+    rng = np.random.RandomState(seed)
+    perms = np.argsort(rng.rand(w - 1, k), axis=1)
+    H_perm = H_basic[:, perms].transpose(1, 0, 2).reshape(-1, k)
+    H = np.vstack((H_basic, H_perm))
     return H
 
-def hierarchical_ldpc(k, t1, t2, _m):
+def hierarchical_ldpc(k, t1, t2, _m, seed=None):
     '''Generates a low density code matrix using a hierarchical approach
 
     k (int):        width of matrix / length of k-mer
@@ -46,22 +58,59 @@ def hierarchical_ldpc(k, t1, t2, _m):
                     (may not be exactly what is returned as the actual
                     height of the matrix is computed below, but the result
                     will be at least _m in height
+    seed (int):     seed for the random permutations (random if None)
     
     returns 0/1 matrix
     '''
-    H = np.ndarray(0)
-    H1 = ldpc(k, t1, _m)
-    H2 = ldpc(t1, t2, _m)
-    H_rows = []
-    for row in range(_m):
-        new_row_indices = H1[row].nonzero()[0][H2[row]]
-        new_row = np.zeros(k, dtype=bool)
-        new_row[new_row_indices] = True
-        H_rows.append(new_row)
-    H = np.vstack(H_rows)
+    rng = np.random.RandomState(seed)
+    seed1, seed2 = rng.randint(0, 2**31 - 1, size=2)
+    H1 = ldpc(k, t1, _m, seed1)
+    H2 = ldpc(t1, t2, _m, seed2)
+    # For each row, keep the t2 of the t1 positions of H1 that H2 selects.
+    # As in write_out, the unpermuted basic rows at the top are skipped.
+    rows1 = pattern_indices(H1[k//t1:k//t1 + _m])
+    rows2 = pattern_indices(H2[t1//t2:t1//t2 + _m])
+    new_rows = rows1[np.arange(_m)[:, None], rows2]
+    H = np.zeros((_m, k), dtype=bool)
+    H[np.arange(_m)[:, None], new_rows] = True
     return H
 
+def pattern_indices(H):
+    '''Converts a 0/1 matrix with the same number of 1's in every row into
+    an array of the (increasing) column indices of the 1's in each row'''
+    return H.nonzero()[1].reshape(len(H), -1)
+
+def binary_pattern_file(d):
+    '''Name of the binary index-array copy of pattern file d'''
+    return os.path.splitext(d)[0] + ".npy"
+
+def write_patterns(rows, d):
+    '''Writes out pattern rows (array of k-mer positions, one row per hash)
+    as a text file for use with modified fasta2skm, and as a binary .npy
+    index array next to it that fasta2skm loads without parsing text'''
+    rows = np.asarray(rows, dtype=np.int32)
+    with open(d, 'w') as fout:
+        fout.write('%d %d\n'%rows.shape)
+        for row in rows:
+            fout.write(''.join('%d '%(j) for j in row))
+            fout.write('\n')
+    np.save(binary_pattern_file(d), rows)
 
+def out_rows(H, _m):
+    '''The pattern rows written out for LDPC matrix H: the contiguous first
+    t positions, followed by _m permuted rows
+
+    H (2D ndarray): 0/1 matrix, output of LDPC above
+    _m (int):       suggestion for height of matrix / number of hashes
+                    (may not be exactly what is returned as the actual
+                    height of the matrix is computed in LDPC above)
+    '''
+    k = len(H[0])
+    t = H[0].sum()
+    m = (int(np.ceil(_m*1.0/(k/t)) + 1)) * (k//t)
+    w = m * t // k
+    st = m//w
+    return np.vstack((np.arange(t)[None, :], pattern_indices(H[st:st + _m])))
 
 def write_out(H, d, _m):
     '''Writes out LDPC matrix in text file for use with modified
@@ -74,28 +123,133 @@ def write_out(H, d, _m):
                     height of the matrix is computed in LDPC above)
 
     '''
-    k = len(H[0])
-    t = H[0].sum()
-    m = (int(np.ceil(_m*1.0/(k/t)) + 1)) * (k//t)
-    w = m * t // k
-    with open(d, 'w') as fout:    
-        fout.write('%d %d\n'%(_m + 1, t))
-        for j in range(t):
-            fout.write('%d '%(j))
-        fout.write('\n')
-        st = m//w
-        for i in range(_m):
-            #sys.stdout.write('%d: '%(i))
-            for j in range(k):
-                if H[st + i, j] == 1:
-                    fout.write('%d '%(j))
-            fout.write('\n')
+    write_patterns(out_rows(H, _m), d)
 
-def ldpc_write(k, t, _m, d):
+def ldpc_write(k, t, _m, d, seed=None):
     '''Generates and writes out LDPC matrix'''
-    H = ldpc(k, t, _m)
+    H = ldpc(k, t, _m, seed)
     write_out(H, d, _m)
 
+def hierarchical_rows(k, t1, t2, _m, seed=None):
+    '''The pattern rows written out for a hierarchical LDPC matrix: like
+    ldpc_write, the contiguous first t2 positions before the _m rows'''
+    H = hierarchical_ldpc(k, t1, t2, _m, seed)
+    return np.vstack((np.arange(t2)[None, :], pattern_indices(H)))
+
+def hierarchical_ldpc_write(k, t1, t2, _m, d, seed=None):
+    '''Generates and writes out hierarchical LDPC matrix. Like ldpc_write,
+    the contiguous first t2 positions are written before the _m rows.'''
+    write_patterns(hierarchical_rows(k, t1, t2, _m, seed), d)
+
+def sensitivity(rows, errors):
+    '''Fraction of the sampled k-mers that still share at least one hashed
+    feature with their error-free copy, i.e. where every position of some
+    pattern row is free of errors
+
+    rows (2D ndarray):      pattern rows (k-mer positions, one row per hash)
+    errors (2D ndarray):    boolean (samples, k) matrix of substituted
+                            positions
+
+    The samples are processed in chunks, so that memory stays bounded by
+    SCORE_CHUNK_BYTES however many hashes there are.
+    '''
+    chunk = max(1, SCORE_CHUNK_BYTES // rows.size)
+    hits = 0
+    for start in range(0, len(errors), chunk):
+        hit = ~errors[start:start + chunk][:, rows].any(axis=2)
+        hits += hit.any(axis=1).sum()
+    return hits * 1.0 / len(errors)
+
+def overlap(rows, k):
+    '''Root mean square, over all pairs of pattern rows, of the fraction of
+    positions the two rows share.
+
+    The plain mean only depends on how many rows use each position, which
+    is the same for every regular LDPC draw; squaring penalizes sets in
+    which some pairs share many positions. The pairwise counts of H.dot(H.T)
+    are computed a block of rows at a time, within SCORE_CHUNK_BYTES.
+    '''
+    m, t = rows.shape
+    if m < 2:
+        return 0.
+    H = np.zeros((m, k), dtype=np.int64)
+    H[np.arange(m)[:, None], rows] = 1
+    chunk = max(1, SCORE_CHUNK_BYTES // (8 * m))
+    squares = 0
+    for start in range(0, m, chunk):
+        shared = H[start:start + chunk].dot(H.T)
+        squares += (shared ** 2).sum()
+    # Each pair is counted twice, and every row shares all t positions
+    # with itself
+    pairs_squares = (squares - m * t * t) / 2.
+    return np.sqrt(pairs_squares / (m * (m - 1) / 2)) / t
+
+def score_candidate(task):
+    '''Draws one candidate pattern set and scores it. The error samples
+    are drawn from error_seed, so every candidate is scored on the same
+    ones. Returns (seed, sensitivity, overlap).'''
+    seed, k, t, _m, hierarchical, error_rate, error_seed, samples = task
+    if hierarchical > 0:
+        rows = hierarchical_rows(k, hierarchical, t, _m, seed)
+    else:
+        rows = out_rows(ldpc(k, t, _m, seed), _m)
+    errors = np.random.RandomState(error_seed).rand(samples, k) < error_rate
+    return (seed, sensitivity(rows, errors), overlap(rows, k))
+
+def design(k, t, _m, candidates, error_rate, seed=None, hierarchical=0,
+        samples=DESIGN_SAMPLES, processes=None):
+    '''Searches candidates randomly drawn LDPC pattern sets for the one
+    best at matching k-mers with substitution errors.
+
+    Each candidate is scored by its sensitivity (see sensitivity) on the same
+    samples k-mers with independent substitutions at rate error_rate, and by
+    the overlap of its rows (see overlap). Among the candidates within one
+    standard error of the best sensitivity, the one with the least overlap
+    wins, the more sensitive one on equal overlap.
+    Candidates are scored in a pool of processes (one per core if None).
+
+    hierarchical (int):     if > 0, draw hierarchical patterns with this
+                            middle level weight (see hierarchical_ldpc)
+
+    Returns (rows, scores): the winning pattern rows, and a list of
+    (seed, sensitivity, overlap) of every candidate, best first.
+    '''
+    rng = np.random.RandomState(seed)
+    seeds = rng.randint(0, 2**31 - 1, size=candidates)
+    error_seed = rng.randint(0, 2**31 - 1)
+    tasks = [(int(s), k, t, _m, hierarchical, error_rate, error_seed, samples)
+            for s in seeds]
+    processes = processes or multiprocessing.cpu_count()
+    if processes > 1 and candidates > 1:
+        pool = multiprocessing.Pool(min(processes, candidates))
+        try:
+            scores = pool.map(score_candidate, tasks,
+                    chunksize=max(1, candidates // (processes * 4)))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        scores = [score_candidate(task) for task in tasks]
+    best = max(s for _, s, _ in scores)
+    margin = np.sqrt(best * (1 - best) / samples)
+    scores.sort(key=lambda c: (c[1] < best - margin,
+        c[2] if c[1] >= best - margin else -c[1], -c[1]))
+    winner = scores[0][0]
+    if hierarchical > 0:
+        rows = hierarchical_rows(k, hierarchical, t, _m, winner)
+    else:
+        rows = out_rows(ldpc(k, t, _m, winner), _m)
+    return (rows, scores)
+
+def design_write(k, t, _m, d, candidates, error_rate, seed=None,
+        hierarchical=0, samples=DESIGN_SAMPLES, processes=None):
+    '''Writes out the best of candidates LDPC pattern sets (see design).
+    Returns the scores of the candidates, best first.'''
+    rows, scores = design(k, t, _m, candidates, error_rate, seed,
+            hierarchical, samples, processes)
+    write_patterns(rows, d)
+    return scores
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -103,11 +257,26 @@ if __name__ == "__main__":
     parser.add_argument('-t', nargs=1)
     parser.add_argument('-m', nargs=1)
     parser.add_argument('-d', nargs=1)
+    parser.add_argument('-w', nargs=1, help='hierarchical middle level weight')
+    parser.add_argument('-s', nargs=1, help='random seed')
+    parser.add_argument('-c', nargs=1, help='number of candidate pattern sets to search')
+    parser.add_argument('-e', nargs=1, help='substitution error rate the candidates are scored at (default 0.1)')
+    parser.add_argument('-p', nargs=1, help='processes scoring candidates (default: one per core)')
     args = parser.parse_args()
     #print args.k, args.t, args.m
     k = int(args.k[0])
     t = int(args.t[0])
     _m = int(args.m[0])
     d = args.d[0]
-    ldpc_write(k, t, _m, d)
-
+    seed = int(args.s[0]) if args.s else None
+    if args.c:
+        scores = design_write(k, t, _m, d, int(args.c[0]),
+                float(args.e[0]) if args.e else 0.1, seed,
+                int(args.w[0]) if args.w else 0,
+                processes=int(args.p[0]) if args.p else None)
+        print('best of %d candidates: sensitivity %.4f, overlap %.4f'%(
+            len(scores), scores[0][1], scores[0][2]))
+    elif args.w:
+        hierarchical_ldpc_write(k, int(args.w[0]), t, _m, d, seed)
+    else:
+        ldpc_write(k, t, _m, d, seed)
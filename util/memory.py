@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+'''
+Memory estimation and monitoring for memory-budgeted Opal training.
+
+The bulk of the memory used by a training batch is the shuffled list of
+vowpal_wabbit example strings, so the estimate is the number of fragments
+drawn times the size of one example line, plus Python's per-string and
+per-list-slot overheads.
+'''
+
+from __future__ import print_function
+import math
+import re
+import resource
+
+from fasta_functions import fasta_reader
+
+# Python 2 str object header and list slot, in bytes
+STR_OVERHEAD = 37
+LIST_SLOT = 8
+# Fraction of the available budget that a batch is planned to use
+SAFETY = 0.8
+# Smallest fraction of the requested per-batch coverage worth running
+MIN_FRACTION = 0.01
+
+UNITS = {'': 1024**3, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+def parse_memory(text):
+    '''Parses a memory size such as "32G", "500M" or "1.5T" into bytes. A
+    bare number is taken to be in GiB.'''
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)i?B?\s*$', text, re.IGNORECASE)
+    if not match:
+        raise ValueError("Could not parse memory size: " + text)
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+def format_memory(num_bytes):
+    '''Formats bytes as MiB for reporting'''
+    return "{:.1f}MiB".format(num_bytes * 1.0 / 1024**2)
+
+def current_rss():
+    '''Returns the resident set size of this process in bytes'''
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    # Peak rather than current RSS, but better than nothing (KiB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def reference_length(fasta):
+    '''Total number of bases in a fasta file'''
+    with open(fasta, 'r') as f:
+        return sum(len(seq) for _, seq in fasta_reader(f))
+
+def example_bytes(frag_length, kmer, num_hash, row_weight, reverse):
+    '''Estimated bytes held for one training example line'''
+    kmers = max(frag_length - kmer + 1, 0)
+    if reverse:
+        kmers = kmers * 2
+    # patterns.txt holds num_hash + 1 patterns, each feature being the
+    # selected bases, the pattern index and a separating space
+    num_patterns = num_hash + 1
+    feature_chars = row_weight + len(str(num_patterns - 1)) + 1
+    line = kmers * num_patterns * feature_chars + 8
+    return line + STR_OVERHEAD + LIST_SLOT
+
+def coverage_bytes(ref_length, frag_length, kmer, num_hash, row_weight,
+        reverse, members=1):
+    '''Estimated bytes used by a batch per unit of coverage. Ensemble
+    members each hold their own copy of the batch.'''
+    fragments = ref_length * 1.0 / frag_length
+    return fragments * example_bytes(frag_length, kmer, num_hash, row_weight,
+            reverse) * members
+
+def plan_coverage(coverage, bytes_per_coverage, budget):
+    '''Returns the largest per-batch coverage, no more than coverage, whose
+    estimated memory use fits into SAFETY * budget bytes'''
+    if budget <= 0:
+        raise ValueError("Memory budget is already used up ({} available)".format(format_memory(budget)))
+    fitting = SAFETY * budget / bytes_per_coverage
+    if fitting < MIN_FRACTION * coverage:
+        raise ValueError("Memory budget too small: {} available fits only coverage {:.4g} per batch".format(
+            format_memory(budget), fitting))
+    return min(coverage, fitting)
+
+def plan_batches(total_coverage, batch_coverage):
+    '''Number of batches needed to reach total_coverage'''
+    return int(math.ceil(total_coverage / batch_coverage - 1e-9))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+'''
+Duplicate-read collapsing and a persistent prediction cache for predict.
+
+Identical reads get identical features, so only one copy of each distinct
+sequence needs to be featurized and scored; the predictions are then
+expanded back to every read in input order. When reverse complements are
+used, a read and its reverse complement have the same features too, so they
+share a key. Paired-end reads are collapsed by pair in the same way.
+
+The prediction cache is a bounded LRU map from read key to vw prediction
+line, saved next to the model so that it persists across runs. It is
+discarded whenever the model files or feature options change.
+'''
+
+from __future__ import print_function
+import array
+import collections
+import hashlib
+import os
+
+from fasta_functions import reverse_complement
+
+def read_key(seq, reverse):
+    '''Digest identifying the features of a read'''
+    if reverse:
+        seq = min(seq, reverse_complement(seq))
+    return hashlib.sha1(seq).digest()
+
+def pair_key(seq, mate, reverse):
+    '''Digest identifying the features of a read pair. The features of the
+    two mates are pooled, so swapping them gives the same key.'''
+    keys = sorted((read_key(seq, reverse), read_key(mate, reverse)))
+    return hashlib.sha1(keys[0] + keys[1]).digest()
+
+def collapse(records, reverse, unique_fasta):
+    '''Writes the first copy of every distinct sequence in records (an
+    iterator over (name, seq, ...) tuples) to unique_fasta.
+
+    Returns (read_map, keys): read_map[i] is the index in unique_fasta of
+    read i, and keys[j] is the key of unique sequence j.
+    '''
+    index_of = {}
+    keys = []
+    read_map = array.array('l')
+    with open(unique_fasta, 'w') as fout:
+        for record in records:
+            seq = record[1]
+            key = read_key(seq, reverse)
+            j = index_of.get(key)
+            if j is None:
+                j = len(keys)
+                index_of[key] = j
+                keys.append(key)
+                fout.write(">{}\n{}\n".format(j, seq))
+            read_map.append(j)
+    return (read_map, keys)
+
+def collapse_pairs(pairs, reverse, unique_fasta, unique_mates):
+    '''Paired-end version of collapse: pairs iterates over the mates of each
+    read pair, and the first copy of every distinct pair is written to
+    unique_fasta and unique_mates'''
+    index_of = {}
+    keys = []
+    read_map = array.array('l')
+    with open(unique_fasta, 'w') as fout, open(unique_mates, 'w') as mout:
+        for record, mate_record in pairs:
+            seq = record[1]
+            mate = mate_record[1]
+            key = pair_key(seq, mate, reverse)
+            j = index_of.get(key)
+            if j is None:
+                j = len(keys)
+                index_of[key] = j
+                keys.append(key)
+                fout.write(">{}\n{}\n".format(j, seq))
+                mout.write(">{}\n{}\n".format(j, mate))
+            read_map.append(j)
+    return (read_map, keys)
+
+def line_offsets(filename):
+    '''Returns the byte offset of every line in filename'''
+    offsets = array.array('l')
+    position = 0
+    with open(filename, 'r') as f:
+        for line in f:
+            offsets.append(position)
+            position += len(line)
+    return offsets
+
+def expand(unique_preds, read_map, outputfile):
+    '''Writes, for every read, the line of unique_preds given by read_map'''
+    offsets = line_offsets(unique_preds)
+    with open(unique_preds, 'r') as fin:
+        with open(outputfile, 'w') as fout:
+            for j in read_map:
+                fin.seek(offsets[j])
+                fout.write(fin.readline())
+
+def model_id(files, kmer, reverse, cascade_threshold=0.):
+    '''Identifies a model by its files' sizes and modification times and
+    the feature and cascade options used with it'''
+    parts = ["kmer={}".format(kmer), "reverse={}".format(bool(reverse))]
+    if cascade_threshold > 0:
+        parts.append("cascade={}".format(cascade_threshold))
+    for f in files:
+        st = os.stat(f)
+        parts.append("{}:{}:{}".format(os.path.abspath(f), st.st_size, int(st.st_mtime)))
+    return hashlib.sha1(" ".join(parts)).hexdigest()
+
+
+class PredictionCache(object):
+    '''Bounded LRU cache of read key -> vw prediction line, stored in a text
+    file whose first line identifies the model it is valid for'''
+    def __init__(self, path, model, max_size):
+        self.path = path
+        self.model = model
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                if f.readline().rstrip('\n') == "# " + model:
+                    for line in f:
+                        key, prediction = line.split('\t', 1)
+                        self.entries[key.decode('hex')] = prediction
+        while len(self.entries) > max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        '''Returns the cached prediction line of key, or None'''
+        prediction = self.entries.pop(key, None)
+        if prediction is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = prediction
+        return prediction
+
+    def put(self, key, prediction):
+        '''Caches a prediction line, evicting the least recently used'''
+        self.entries.pop(key, None)
+        self.entries[key] = prediction
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        '''Writes the cache through a temporary file and a rename'''
+        tmp = "{}.tmp{}".format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write("# {}\n".format(self.model))
+            for key, prediction in self.entries.items():
+                f.write("{}\t{}".format(key.encode('hex'), prediction))
+        os.rename(tmp, self.path)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+'''
+Vectorized read trimming and filtering before feature generation.
+
+Reads are trimmed at the first window whose mean quality falls below a
+threshold (as in Trimmomatic's SLIDINGWINDOW), and dropped if they are too
+short, contain too many Ns, or are of low complexity (Shannon entropy of
+their trinucleotide composition). Each step works on the read as a numpy
+array. Counts of what was dropped and how many features were saved are kept
+for reporting.
+'''
+
+from __future__ import print_function
+import array
+import os
+import numpy as np
+
+from fasta_functions import fastx_reader, paired_reader
+
+# Written in place of a mate that fails the filters while the other mate
+# passes; it is too short to give any k-mers
+DROPPED_MATE = "N"
+
+# 2-bit codes of the bases, -1 for anything else
+BASE_CODES = np.full(256, -1, dtype=np.int16)
+for i, bases in enumerate(("Aa", "Cc", "Gg", "Tt")):
+    for base in bases:
+        BASE_CODES[ord(base)] = i
+
+class ReadFilter(object):
+    '''Trims and filters reads, keeping count of what it removes.
+
+    trim_quality (int):     trim from the first window whose mean quality is
+                            below this (0 disables trimming)
+    trim_window (int):      width of the quality window
+    max_n_fraction (float): drop reads with a larger fraction of Ns
+    min_length (int):       drop reads shorter than this after trimming
+    min_complexity (float): drop reads whose trinucleotide entropy, in bits
+                            (at most 6), is below this (0 disables)
+    kmer (int):             k-mer length, for counting saved features
+    num_patterns (int):     features per k-mer, for counting saved features
+    reverse (bool):         whether reverse complement features are used
+    phred_offset (int):     quality score encoding offset
+    '''
+    def __init__(self, trim_quality=0, trim_window=4, max_n_fraction=1.0,
+            min_length=0, min_complexity=0., kmer=64, num_patterns=1,
+            reverse=False, phred_offset=33):
+        self.trim_quality = trim_quality
+        self.trim_window = trim_window
+        self.max_n_fraction = max_n_fraction
+        self.min_length = min_length
+        self.min_complexity = min_complexity
+        self.kmer = kmer
+        self.num_patterns = num_patterns
+        self.reverse = reverse
+        self.phred_offset = phred_offset
+
+        # counters
+        self.reads = 0
+        self.kept = 0
+        self.dropped_short = 0
+        self.dropped_n = 0
+        self.dropped_complexity = 0
+        self.trimmed_reads = 0
+        self.trimmed_bases = 0
+        self.features_saved = 0
+
+    def features(self, length):
+        '''Number of features generated for a read of the given length'''
+        kmers = max(length - self.kmer + 1, 0)
+        if self.reverse:
+            kmers = kmers * 2
+        return kmers * self.num_patterns
+
+    def trim_length(self, qual):
+        '''Length to keep: up to the first window with low mean quality'''
+        q = np.frombuffer(qual, dtype=np.uint8).astype(np.int32) - self.phred_offset
+        window = min(self.trim_window, len(q))
+        if window == 0:
+            return 0
+        sums = np.cumsum(np.concatenate(([0], q)))
+        means = (sums[window:] - sums[:-window]) * 1.0 / window
+        low = np.flatnonzero(means < self.trim_quality)
+        if len(low) == 0:
+            return len(q)
+        return int(low[0])
+
+    def complexity(self, seq):
+        '''Shannon entropy, in bits, of the trinucleotides of seq'''
+        codes = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+        if len(codes) < 3:
+            return 0.
+        triplets = codes[:-2] * 16 + codes[1:-1] * 4 + codes[2:]
+        valid = (codes[:-2] >= 0) & (codes[1:-1] >= 0) & (codes[2:] >= 0)
+        counts = np.bincount(triplets[valid], minlength=64)
+        total = counts.sum()
+        if total == 0:
+            return 0.
+        p = counts[counts > 0] * 1.0 / total
+        return float(-(p * np.log2(p)).sum())
+
+    def apply(self, seq, qual=None):
+        '''Returns the trimmed read, or None if it is dropped'''
+        self.reads += 1
+        original_features = self.features(len(seq))
+        if qual is not None and self.trim_quality > 0:
+            length = self.trim_length(qual)
+            if length < len(seq):
+                self.trimmed_reads += 1
+                self.trimmed_bases += len(seq) - length
+                seq = seq[:length]
+        if len(seq) < self.min_length or len(seq) == 0:
+            self.dropped_short += 1
+        elif self.max_n_fraction < 1.0 and \
+                (seq.count('N') + seq.count('n')) > self.max_n_fraction * len(seq):
+            self.dropped_n += 1
+        elif self.min_complexity > 0 and self.complexity(seq) < self.min_complexity:
+            self.dropped_complexity += 1
+        else:
+            self.kept += 1
+            self.features_saved += original_features - self.features(len(seq))
+            return seq
+        self.features_saved += original_features
+        return None
+
+    def report(self):
+        '''Multi-line summary of the filter counters'''
+        return '''Read filter:    {reads} reads, {kept} kept
+  trimmed:      {trimmed_reads} reads, {trimmed_bases} bases
+  dropped:      {dropped_short} short, {dropped_n} N-rich, {dropped_complexity} low complexity
+  features saved: {features_saved}'''.format(**self.__dict__)
+
+def filter_fastx(infile, outfile, read_filter):
+    '''Writes the trimmed reads of FASTA/FASTQ infile that pass read_filter
+    to outfile as fasta. Returns an array with, for every input read, 1 if
+    it was kept and 0 if it was dropped.'''
+    keep = array.array('b')
+    with open(infile, 'r') as fin:
+        with open(outfile, 'w') as fout:
+            for name, seq, qual in fastx_reader(fin):
+                trimmed = read_filter.apply(seq, qual)
+                if trimmed is None:
+                    keep.append(0)
+                else:
+                    keep.append(1)
+                    fout.write(">{}\n{}\n".format(name, trimmed))
+    return keep
+
+def filter_pairs(infile, mate_infile, outfile, mate_outfile, read_filter):
+    '''Paired-end version of filter_fastx: a pair is dropped only if both
+    mates fail the filters, and a failing mate of a kept pair is written as
+    DROPPED_MATE. Returns the keep array, with one entry per pair.'''
+    keep = array.array('b')
+    with open(infile, 'r') as fin, open(mate_infile, 'r') as min_:
+        with open(outfile, 'w') as fout, open(mate_outfile, 'w') as mout:
+            for (name, seq, qual), (mate_name, mate, mate_qual) in paired_reader(fin, min_):
+                trimmed = read_filter.apply(seq, qual)
+                trimmed_mate = read_filter.apply(mate, mate_qual)
+                if trimmed is None and trimmed_mate is None:
+                    keep.append(0)
+                else:
+                    keep.append(1)
+                    fout.write(">{}\n{}\n".format(name, trimmed or DROPPED_MATE))
+                    mout.write(">{}\n{}\n".format(mate_name, trimmed_mate or DROPPED_MATE))
+    return keep
+
+def filter_batch(fasta, line_files, read_filter):
+    '''Filters a fasta file of training fragments in place, dropping the
+    matching lines of the line_files (one line per fragment, e.g. taxids)'''
+    keep = filter_fastx(fasta, fasta + ".tmp", read_filter)
+    os.rename(fasta + ".tmp", fasta)
+    for line_file in line_files:
+        with open(line_file, 'r') as fin:
+            with open(line_file + ".tmp", 'w') as fout:
+                for kept, line in zip(keep, fin):
+                    if kept:
+                        fout.write(line)
+        os.rename(line_file + ".tmp", line_file)
+    return keep
+
+def restore_dropped(prediction_file, keep, unclassified_line):
+    '''Rewrites a prediction file holding one line per kept read so that it
+    holds one line per input read, with unclassified_line for dropped reads'''
+    tmp = prediction_file + ".tmp"
+    with open(prediction_file, 'r') as fin:
+        with open(tmp, 'w') as fout:
+            for kept in keep:
+                fout.write(fin.readline() if kept else unclassified_line)
+    os.rename(tmp, prediction_file)
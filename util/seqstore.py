@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+'''
+2-bit packed, memory-mapped reference sequence store.
+
+A reference fasta and its taxid file are converted once into a directory
+holding the bases packed 4 to a byte, with every record starting on a byte
+boundary, plus:
+
+    records.npy     (start, length) of each record, in bases
+    nmask.npy       (start, length, character) runs of anything but ACGT,
+                    such as runs of N, so that they are restored exactly
+    lowercase.npy   (start, length) runs of soft-masked (lowercase) bases
+    names.txt       record names, one per line
+    taxids.txt      record taxids, one per line
+    store.json      sizes and format version
+
+The packed bases are memory-mapped, so opening a store is instant and
+concurrent jobs share it through the page cache. Records are returned as
+StoredSequence objects that decode only the slices asked for, or the whole
+record with str(); decoding a record in one go is much faster per base than
+slicing it fragment by fragment, which is what drawfrag does.
+'''
+
+from __future__ import print_function
+__version__ = "0.0.1"
+import argparse
+import json
+import os
+import shutil
+import sys
+import numpy as np
+
+from fasta_functions import fasta_reader
+
+FORMAT_VERSION = 1
+STORE_FILE = "store.json"
+
+# 2-bit codes of the bases (either case), -1 for anything else
+BASE_CODES = np.full(256, -1, dtype=np.int16)
+for i, base in enumerate("ACGT"):
+    BASE_CODES[ord(base)] = i
+    BASE_CODES[ord(base.lower())] = i
+# The 4 bases packed into each byte value, first base in the high bits
+UNPACK = np.array([[ord("ACGT"[(b >> shift) & 3]) for shift in (6, 4, 2, 0)]
+    for b in range(256)], dtype=np.uint8)
+
+def runs(positions):
+    '''Splits sorted positions into runs of consecutive values, returning
+    the start and length of each run'''
+    if len(positions) == 0:
+        return (positions, positions)
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    starts = positions[np.concatenate(([0], breaks))]
+    ends = positions[np.concatenate((breaks - 1, [len(positions) - 1]))] + 1
+    return (starts, ends - starts)
+
+def pack(seq):
+    '''Packs the bases of seq 4 to a byte (padding the last byte with A).
+    Returns the packed bytes, the (start, length, character) runs of
+    non-ACGT characters and the (start, length) runs of lowercase letters,
+    relative to the start of seq.'''
+    raw = np.frombuffer(seq, dtype=np.uint8)
+    codes = BASE_CODES[raw]
+    # Runs of the same non-ACGT character
+    other = np.flatnonzero(codes < 0)
+    chars = raw[other]
+    if len(other) > 0:
+        new_run = np.ones(len(other), dtype=bool)
+        new_run[1:] = (np.diff(other) != 1) | (chars[1:] != chars[:-1])
+        starts = other[new_run]
+        lengths = np.diff(np.concatenate((np.flatnonzero(new_run), [len(other)])))
+        nmask = np.column_stack((starts, lengths, chars[new_run])).astype(np.int64)
+    else:
+        nmask = np.zeros((0, 3), dtype=np.int64)
+    # Runs of lowercase bases (other lowercase characters are kept as is)
+    lower_starts, lower_lengths = runs(np.flatnonzero((raw >= ord('a')) & (codes >= 0)))
+    lowercase = np.column_stack((lower_starts, lower_lengths)).astype(np.int64)
+    codes = np.where(codes < 0, 0, codes).astype(np.uint8)
+    padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    quads = padded.reshape(-1, 4)
+    packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+    return (packed.astype(np.uint8), nmask, lowercase)
+
+def build(fasta, taxids, store_dir):
+    '''Converts fasta and its taxid file (one line per record) into a store
+    in store_dir, replacing any store there. Records are read one at a time.
+    Returns the opened store.'''
+    tmp_dir = store_dir + ".tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    records = []
+    nmasks = []
+    lowercases = []
+    position = 0
+    with open(fasta, 'r') as fin, open(taxids, 'r') as tin, \
+            open(os.path.join(tmp_dir, "sequence.2bit"), 'wb') as seq_out, \
+            open(os.path.join(tmp_dir, "names.txt"), 'w') as name_out, \
+            open(os.path.join(tmp_dir, "taxids.txt"), 'w') as taxid_out:
+        for name, seq in fasta_reader(fin):
+            packed, nmask, lowercase = pack(seq)
+            packed.tofile(seq_out)
+            nmask[:, 0] += position
+            lowercase[:, 0] += position
+            nmasks.append(nmask)
+            lowercases.append(lowercase)
+            records.append((position, len(seq)))
+            position += len(packed) * 4
+            name_out.write(name.replace('\n', ' ') + "\n")
+            taxid_out.write(tin.readline().rstrip('\n') + "\n")
+    np.save(os.path.join(tmp_dir, "records.npy"),
+            np.array(records, dtype=np.int64).reshape(-1, 2))
+    np.save(os.path.join(tmp_dir, "nmask.npy"),
+            np.concatenate(nmasks) if nmasks else np.zeros((0, 3), dtype=np.int64))
+    np.save(os.path.join(tmp_dir, "lowercase.npy"),
+            np.concatenate(lowercases) if lowercases else np.zeros((0, 2), dtype=np.int64))
+    with open(os.path.join(tmp_dir, STORE_FILE), 'w') as f:
+        json.dump({
+            "version": FORMAT_VERSION,
+            "records": len(records),
+            "bases": int(sum(length for _, length in records)),
+            "packed_bytes": position // 4,
+            "fasta": os.path.abspath(fasta),
+            "taxids": os.path.abspath(taxids)}, f, indent=1, sort_keys=True)
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+    return SeqStore(store_dir)
+
+def is_current(store_dir, sources):
+    '''Whether store_dir holds a complete store at least as new as every
+    file in sources'''
+    store_file = os.path.join(store_dir, STORE_FILE)
+    if not os.path.isfile(store_file):
+        return False
+    mtime = os.path.getmtime(store_file)
+    return all(os.path.getmtime(source) <= mtime for source in sources)
+
+
+class SeqStore(object):
+    '''A reference sequence store opened read-only, with the packed bases
+    memory-mapped'''
+    def __init__(self, store_dir):
+        self.path = os.path.abspath(store_dir)
+        with open(os.path.join(store_dir, STORE_FILE), 'r') as f:
+            self.info = json.load(f)
+        if self.info["version"] != FORMAT_VERSION:
+            raise RuntimeError("Unsupported sequence store version {} in {}; rerun index".format(self.info["version"], store_dir))
+        self.records = np.load(os.path.join(store_dir, "records.npy"))
+        nmask = np.load(os.path.join(store_dir, "nmask.npy"))
+        lowercase = np.load(os.path.join(store_dir, "lowercase.npy"))
+        self.nmask_starts = nmask[:, 0]
+        self.nmask_ends = nmask[:, 0] + nmask[:, 1]
+        self.nmask_chars = nmask[:, 2].astype(np.uint8)
+        self.lower_starts = lowercase[:, 0]
+        self.lower_ends = lowercase[:, 0] + lowercase[:, 1]
+        if self.info["packed_bytes"] > 0:
+            self.packed = np.memmap(os.path.join(store_dir, "sequence.2bit"),
+                    dtype=np.uint8, mode='r')
+        else:
+            self.packed = np.zeros(0, dtype=np.uint8)
+        with open(os.path.join(store_dir, "names.txt"), 'r') as f:
+            self.names = [line.rstrip('\n') for line in f]
+        with open(os.path.join(store_dir, "taxids.txt"), 'r') as f:
+            self.taxids = [line.rstrip('\n') for line in f]
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def bases(self):
+        '''Total number of bases in the store'''
+        return self.info["bases"]
+
+    def fetch(self, start, length):
+        '''Decodes length bases from global base position start'''
+        if length <= 0:
+            return ''
+        first = start // 4
+        last = (start + length + 3) // 4
+        shift = start - first * 4
+        chars = UNPACK[self.packed[first:last]].ravel()[shift:shift + length]
+        end = start + length
+        i0 = np.searchsorted(self.nmask_ends, start, side='right')
+        i1 = np.searchsorted(self.nmask_starts, end, side='left')
+        for s, e, c in zip(self.nmask_starts[i0:i1], self.nmask_ends[i0:i1],
+                self.nmask_chars[i0:i1]):
+            chars[max(s, start) - start:min(e, end) - start] = c
+        i0 = np.searchsorted(self.lower_ends, start, side='right')
+        i1 = np.searchsorted(self.lower_starts, end, side='left')
+        for s, e in zip(self.lower_starts[i0:i1], self.lower_ends[i0:i1]):
+            chars[max(s, start) - start:min(e, end) - start] |= 32
+        return chars.tostring()
+
+    def sequence(self, index):
+        '''Returns record index as a StoredSequence'''
+        return StoredSequence(self, index)
+
+    def __iter__(self):
+        '''Yields (name, taxid, StoredSequence) for every record'''
+        for index in xrange(len(self)):
+            taxid = self.taxids[index] if index < len(self.taxids) else ''
+            yield (self.names[index], taxid, self.sequence(index))
+
+
+class StoredSequence(object):
+    '''A record of a SeqStore that behaves like a str for len() and slicing,
+    decoding only the bases asked for. Pickles as the store path and record
+    index, so that pool workers map the same store.'''
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+        self.start, self.length = (int(x) for x in store.records[index])
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                raise ValueError("StoredSequence slices must be contiguous")
+            return self.store.fetch(self.start + start, stop - start)
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError("StoredSequence index out of range")
+        return self.store.fetch(self.start + key, 1)
+
+    def __getslice__(self, i, j):
+        # Python 2 calls this for simple slices
+        return self.__getitem__(slice(i, j))
+
+    def __str__(self):
+        return self.store.fetch(self.start, self.length)
+
+    def __reduce__(self):
+        return (stored_sequence, (self.store.path, self.index))
+
+_open_stores = {}
+
+def open_store(store_dir):
+    '''Opens store_dir, reusing the store already opened by this process'''
+    path = os.path.abspath(store_dir)
+    if path not in _open_stores:
+        _open_stores[path] = SeqStore(path)
+    return _open_stores[path]
+
+def stored_sequence(store_dir, index):
+    '''Record index of the store in store_dir (used for unpickling)'''
+    return open_store(store_dir).sequence(index)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            formatter_class=argparse.RawTextHelpFormatter,
+            description=__doc__)
+    parser.add_argument('--version', action='version',
+            version='%(prog)s {version}'.format(version=__version__))
+    parser.add_argument('-i', '--input', help='input fasta file [required]')
+    parser.add_argument('-t', '--taxids', help='one-column file containing the taxid of each input sequence [required]')
+    parser.add_argument('-o', '--output', help='output store directory [required]')
+    args = parser.parse_args(argv)
+    store = build(args.input, args.taxids, args.output)
+    print("{} records, {} bases, {} packed bytes".format(
+        len(store), store.bases, store.info["packed_bytes"]))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
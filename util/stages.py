@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+Dependency-tracked stage manifests for the Opal simulate pipeline.
+
+Each stage (frag, train, predict) records a manifest in its output
+directory once it completes: the checksums of its input files, the
+arguments and seeds it depends on, the Opal version, the results of the
+upstream stages it used, and the files it produced with their checksums.
+A stage's result combines its digest with the checksums of its outputs, so
+a stage that reruns and produces anything different (e.g. new random
+patterns) changes what every downstream stage sees. A rerun can skip any
+stage whose manifest still matches and whose outputs are unchanged, so
+exactly the stages after a change rerun.
+
+Checksums are reused from the previous manifest while a file's size and
+modification time are unchanged, so checking a large reference does not
+mean reading it again.
+'''
+
+from __future__ import print_function
+import hashlib
+import json
+import os
+
+MANIFEST = "stage.json"
+
+def file_sha1(path):
+    '''SHA-1 of the contents of path'''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def file_info(path, previous=None):
+    '''Size, modification time and checksum of path, taking the checksum
+    from previous (an earlier file_info of the same file) if the size and
+    modification time are unchanged'''
+    st = os.stat(path)
+    info = {"path": os.path.abspath(path), "size": st.st_size,
+            "mtime": st.st_mtime}
+    if (previous is not None and previous["path"] == info["path"] and
+            previous["size"] == info["size"] and
+            previous["mtime"] == info["mtime"]):
+        info["sha1"] = previous["sha1"]
+    else:
+        info["sha1"] = file_sha1(path)
+    return info
+
+def load(stage_dir):
+    '''Returns the manifest recorded in stage_dir, or None'''
+    path = os.path.join(stage_dir, MANIFEST)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def manifest(stage, inputs, params, upstream=(), version=None,
+        previous=None):
+    '''Describes a run of a stage.
+
+    stage (string):     stage name
+    inputs (dict):      input role --> file path
+    params (dict):      JSON-serializable arguments and seeds the stage
+                        output depends on
+    upstream (list):    recorded manifests of the stages whose outputs are
+                        used; their results (see record) are part of the
+                        digest
+    version (string):   version of the code running the stage
+    previous (dict):    the stage's last manifest, whose checksums are
+                        reused for unchanged files
+
+    The digest covers everything but file paths, sizes and times, so moving
+    or touching an input does not count as a change.
+    '''
+    previous_inputs = previous["inputs"] if previous is not None else {}
+    m = {
+        "stage": stage,
+        "version": version,
+        "inputs": dict((role, file_info(path, previous_inputs.get(role)))
+            for role, path in inputs.items()),
+        "params": params,
+        "upstream": [u["result"] for u in upstream]}
+    key = {
+        "stage": stage,
+        "version": version,
+        "inputs": dict((role, info["sha1"]) for role, info in m["inputs"].items()),
+        "params": params,
+        "upstream": m["upstream"]}
+    m["digest"] = hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+    return m
+
+def is_current(stage_dir, expected):
+    '''Whether stage_dir holds a completed run matching the manifest
+    expected, with all its outputs still present and unchanged'''
+    recorded = load(stage_dir)
+    if (recorded is None or recorded["digest"] != expected["digest"] or
+            "output_files" not in recorded):
+        return False
+    for info in recorded["output_files"]:
+        if not os.path.exists(info["path"]):
+            return False
+        if file_info(info["path"], info)["sha1"] != info["sha1"]:
+            return False
+    return True
+
+def invalidate(stage_dir):
+    '''Removes the manifest of stage_dir before the stage reruns, so that an
+    interrupted run is never taken as complete'''
+    path = os.path.join(stage_dir, MANIFEST)
+    if os.path.isfile(path):
+        os.remove(path)
+
+def record(stage_dir, m, outputs):
+    '''Records a completed run of the stage described by m, which produced
+    outputs (a list of paths), through a temporary file and a rename.
+    Returns the recorded manifest, whose "result" digest covers the stage
+    digest and the checksums of the outputs.'''
+    m = dict(m)
+    m["outputs"] = [os.path.abspath(path) for path in outputs]
+    m["output_files"] = [file_info(path) for path in m["outputs"]]
+    key = {
+        "digest": m["digest"],
+        "outputs": [info["sha1"] for info in m["output_files"]]}
+    m["result"] = hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+    path = os.path.join(stage_dir, MANIFEST)
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(m, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+    return m
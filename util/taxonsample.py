@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''
+Taxon-balanced fragment budgets for Opal training.
+
+By default every reference record is covered the same number of times, so
+taxa with large genomes, or many strains, make up most of every training
+batch. Here each taxid instead gets a budget of fragments, optionally
+capped at a maximum coverage of its records and raised to a minimum, which
+is then split between its records in proportion to their lengths. The
+fragment counts per record are what drawfrag --fragments reads.
+
+Taxa that end up with fewer fragments than the budget can be given larger
+vowpal_wabbit importance weights (budget / fragments), so that every taxon
+weighs the same in training.
+'''
+
+from __future__ import print_function
+import collections
+import numpy as np
+
+from fasta_functions import fasta_reader
+
+def record_lengths(fasta, taxids):
+    '''Returns the length and taxid of every record of fasta, reading the
+    taxids one line per record as drawfrag does'''
+    lengths = []
+    labels = []
+    with open(fasta, 'r') as fin:
+        with open(taxids, 'r') as tin:
+            for _, seq in fasta_reader(fin):
+                lengths.append(len(seq))
+                labels.append(tin.readline().rstrip('\n'))
+    return (lengths, labels)
+
+def split_counts(total, sizes):
+    '''Splits total into integers proportional to sizes, by largest
+    remainder (ties go to the earlier entry)'''
+    sizes = np.asarray(sizes, dtype=np.float64)
+    if total <= 0 or sizes.sum() <= 0:
+        return np.zeros(len(sizes), dtype=np.int64)
+    shares = total * sizes / sizes.sum()
+    counts = np.floor(shares).astype(np.int64)
+    remainder = int(total - counts.sum())
+    if remainder > 0:
+        order = np.argsort(-(shares - counts), kind='mergesort')
+        counts[order[:remainder]] += 1
+    return counts
+
+def fragment_counts(lengths, taxids, frag_length, budget, max_coverage=0.,
+        minimum=0):
+    '''Plans the fragments to draw from each record.
+
+    lengths (list):         record lengths
+    taxids (list):          record taxids
+    frag_length (int):      fragment length; shorter records are skipped
+    budget (int):           fragments per taxid
+    max_coverage (float):   if > 0, at most this coverage of a taxid's
+                            records is drawn
+    minimum (int):          fragments per taxid drawn regardless of the cap
+
+    Returns (counts, taxon_counts): the fragments of each record, and an
+    OrderedDict of taxid --> fragments, in order of first appearance.
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    eligible = np.where(lengths >= frag_length, lengths, 0)
+    members = collections.OrderedDict()
+    for index, taxid in enumerate(taxids):
+        members.setdefault(taxid, []).append(index)
+    counts = np.zeros(len(lengths), dtype=np.int64)
+    taxon_counts = collections.OrderedDict()
+    for taxid, indices in members.items():
+        sizes = eligible[indices]
+        if sizes.sum() == 0:
+            taxon_counts[taxid] = 0
+            continue
+        n = budget
+        if max_coverage > 0:
+            n = min(n, int(max_coverage * sizes.sum() / frag_length))
+        n = max(n, minimum)
+        counts[indices] = split_counts(n, sizes)
+        taxon_counts[taxid] = n
+    return (counts, taxon_counts)
+
+def taxon_weights(taxon_counts, budget):
+    '''Importance weight of each taxid's examples, making the total weight of
+    every taxid with fragments equal to budget'''
+    return dict((taxid, budget * 1.0 / n)
+            for taxid, n in taxon_counts.items() if n > 0)
+
+def write_counts(counts, path):
+    '''Writes per-record fragment counts, one per line, for drawfrag'''
+    with open(path, 'w') as f:
+        for count in counts:
+            f.write("{}\n".format(count))
+
+def report(taxon_counts, weights=None):
+    '''Table of the fragments (and weight) planned for each taxid'''
+    lines = ["taxid\tfragments" + ("\tweight" if weights else "")]
+    for taxid, n in taxon_counts.items():
+        line = "{}\t{}".format(taxid, n)
+        if weights:
+            line += "\t{:.4g}".format(weights.get(taxid, 0.))
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+'''
+Asynchronous I/O driver for a vowpal_wabbit subprocess.
+
+Examples are collected into large buffers that a background thread writes to
+vw's stdin through a bounded queue, so the producer only blocks when vw falls
+behind. A second thread tails vw's log file, echoes it, and parses the
+progress table so that the latest example count and loss are available while
+vw runs. Counters for queue depth and time spent blocked are kept so that
+back-pressure from vw is visible.
+'''
+
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import threading
+import time
+import Queue
+
+class VWProgress(object):
+    '''Tails a vw log file in a background thread, echoing and parsing it'''
+    def __init__(self, log_file, echo=True, interval=0.5):
+        self.fh = open(log_file, 'r')
+        self.fh.seek(0, os.SEEK_END)
+        self.echo = echo
+        self.interval = interval
+        self.examples = 0
+        self.average_loss = None
+        self.since_last = None
+        self.partial = ''
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def parse(self, line):
+        '''Picks up vw progress lines of the form
+        "average-loss since-last example-counter example-weight ..."'''
+        fields = line.split()
+        if len(fields) < 4:
+            return
+        try:
+            average_loss = float(fields[0].rstrip('h'))
+            since_last = float(fields[1].rstrip('h'))
+            examples = int(fields[2])
+        except ValueError:
+            return
+        self.average_loss = average_loss
+        self.since_last = since_last
+        self.examples = examples
+
+    def poll(self):
+        data = self.fh.read()
+        if not data:
+            return
+        if self.echo:
+            print(data, end="")
+            sys.stdout.flush()
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.parse(line)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.poll()
+        if self.partial:
+            self.parse(self.partial)
+            self.partial = ''
+        self.fh.close()
+
+
+class VWDriver(object):
+    '''Runs vw with stdin fed from a background writer thread.
+
+    vw_params (list):   vw command line
+    log_file (string):  file receiving vw's stderr (and stdout unless stdout
+                        is given)
+    log_mode (string):  'w' to truncate log_file, 'a' to append to it
+    stdout:             passed to subprocess.Popen; defaults to log_file
+    buffer_size (int):  bytes of examples collected before a write
+    queue_size (int):   number of buffers that may wait for the writer
+    echo (bool):        whether to print vw's log as it is written
+    env (dict):         environment for vw
+    '''
+    def __init__(self, vw_params, log_file, log_mode='w', stdout=None,
+            buffer_size=1<<22, queue_size=8, echo=True, env=None):
+        self.vw_params = vw_params
+        self.log_file = log_file
+        self.log_fh = open(log_file, log_mode)
+        self.progress = VWProgress(log_file, echo=echo)
+        self.process = subprocess.Popen(vw_params, env=env,
+                stdin=subprocess.PIPE,
+                stdout=self.log_fh if stdout is None else stdout,
+                stderr=self.log_fh)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.closed = False
+
+        # counters
+        self.examples = 0
+        self.bytes_written = 0
+        self.buffers = 0
+        self.queue_depth_total = 0
+        self.max_queue_depth = 0
+        self.blocked_time = 0.
+        self.write_time = 0.
+
+        self.writer = threading.Thread(target=self.write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    @property
+    def stdout(self):
+        return self.process.stdout
+
+    def write_loop(self):
+        stdin = self.process.stdin
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is not None:
+                continue
+            t = time.time()
+            try:
+                stdin.write(chunk)
+                stdin.flush()
+            except (IOError, OSError) as e:
+                self.error = e
+            self.write_time += time.time() - t
+            self.bytes_written += len(chunk)
+
+    def put(self, chunk):
+        '''Queues a chunk, recording time spent waiting on a full queue'''
+        depth = self.queue.qsize()
+        self.queue_depth_total += depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        self.buffers += 1
+        t = time.time()
+        while True:
+            if self.error is not None:
+                raise RuntimeError("Writing to vowpal_wabbit failed ({}); see {}".format(self.error, self.log_file))
+            try:
+                self.queue.put(chunk, timeout=1)
+                break
+            except Queue.Full:
+                pass
+        self.blocked_time += time.time() - t
+
+    def write(self, line):
+        '''Sends one newline terminated example to vw'''
+        self.buffer.append(line)
+        self.buffered += len(line)
+        self.examples += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        '''Hands any buffered examples to the writer thread'''
+        if self.buffer:
+            self.put(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def finish(self):
+        '''Sends the remaining examples and closes vw's stdin, without
+        waiting for vw to exit. Drivers of vw processes that wait on each
+        other (e.g. allreduce workers) must all be finished before any of
+        them is closed.'''
+        if self.writer is None:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+
+    def close(self):
+        '''Sends the remaining examples, closes vw's stdin and waits for vw
+        to exit. Raises RuntimeError if vw fails.'''
+        self.finish()
+        returncode = self.process.wait()
+        self.progress.stop()
+        self.log_fh.close()
+        self.closed = True
+        if self.error is not None or returncode != 0:
+            raise RuntimeError("vowpal_wabbit exited with status {}; see {}".format(returncode, self.log_file))
+        return returncode
+
+    def abort(self):
+        '''Kills vw and stops the writer and progress threads, for when the
+        examples cannot be completed (e.g. the producer raised). Does
+        nothing once the driver is closed, so it can go in a finally clause.'''
+        if self.closed:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        if self.writer is not None:
+            # With vw gone the writer fails fast and drains the queue
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.progress.stop()
+        self.log_fh.close()
+        self.closed = True
+
+    def stats(self):
+        '''Returns a dictionary of driver counters'''
+        return {
+            "examples": self.examples,
+            "bytes_written": self.bytes_written,
+            "buffers": self.buffers,
+            "mean_queue_depth": self.queue_depth_total * 1.0 / max(self.buffers, 1),
+            "max_queue_depth": self.max_queue_depth,
+            "blocked_time": self.blocked_time,
+            "write_time": self.write_time,
+            "vw_examples": self.progress.examples,
+            "vw_average_loss": self.progress.average_loss}
+
+    def report(self):
+        '''One-line summary of the driver counters'''
+        return ("vw driver: {examples} examples, {bytes_written} bytes in "
+                "{buffers} buffers; queue depth mean {mean_queue_depth:.2f} "
+                "max {max_queue_depth}; producer blocked {blocked_time:.2f}s, "
+                "writer blocked {write_time:.2f}s").format(**self.stats())
+
+
+class SpanningTree(object):
+    '''Runs vw's spanning_tree daemon in the foreground, for coordinating
+    allreduce (--span_server) workers on this host.
+
+    port (int):         port to listen on
+    log_file (string):  file receiving the daemon's output
+    env (dict):         environment for spanning_tree
+    '''
+    def __init__(self, port=26543, log_file=os.devnull, env=None):
+        self.port = port
+        self.log_fh = open(log_file, 'a')
+        try:
+            self.process = subprocess.Popen(
+                    ["spanning_tree", "--nondaemon", "--port", str(port)],
+                    env=env, stdout=self.log_fh, stderr=self.log_fh)
+        except OSError as e:
+            self.log_fh.close()
+            raise RuntimeError("Could not start vowpal_wabbit's spanning_tree ({}); is it in the system path?".format(e))
+        # Give the daemon a moment to bind its port before workers connect
+        time.sleep(0.5)
+        if self.process.poll() is not None:
+            self.log_fh.close()
+            raise RuntimeError("spanning_tree exited with status {}; see {}".format(self.process.returncode, log_file))
+
+    def stop(self):
+        '''Terminates the daemon'''
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.log_fh.close()